@@ -1,11 +1,14 @@
 import argparse
 
-def getConfig():
+
+def get_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('action', type=str, default='train', help='Model Training or Testing options')
+    parser.add_argument('action', type=str, default='train', help='Model Training or Testing options (train, test, apply, pack, benchmark, export, quantize, prewarm, serve, loadgen)')
     parser.add_argument('--exp_num', default=0, type=str, help='experiment_number')
     parser.add_argument('--dataset', type=str, default='', help='dataset folder name')
     parser.add_argument('--data_path', type=str, default='data/')
+    parser.add_argument('--packed_data', type=str, default=None,
+                        help='Packed training set path (without .bin/.json), written by the pack action')
 
     # Model parameter settings
     parser.add_argument('--arch', type=str, default='0', help='Backbone Architecture')
@@ -14,6 +17,13 @@ def getConfig():
     parser.add_argument('--frequency_radius', type=int, default=16, help='Frequency radius r in FFT')
     parser.add_argument('--denoise', type=float, default=0.93, help='Denoising background ratio')
     parser.add_argument('--gamma', type=float, default=0.1, help='Confidence ratio')
+    parser.add_argument('--weights_dir', type=str, default=None,
+                        help='Pretrained EfficientNet weight store (default: $TRACER_WEIGHTS_DIR or ~/.cache/tracer/weights)')
+    parser.add_argument('--weights_source', type=str, default=None,
+                        help='prewarm: folder of release .pth files to import instead of downloading')
+    parser.add_argument('--prewarm_archs', type=str, nargs='+', default=None, help='prewarm: backbones (default: --arch)')
+    parser.add_argument('--prewarm_variants', type=str, nargs='+', default=['standard', 'advprop'],
+                        help='prewarm: standard and / or advprop weights (TRACER loads advprop)')
 
     # Training parameter settings
     parser.add_argument('--img_size', type=int, default=320)
@@ -23,6 +33,8 @@ def getConfig():
     parser.add_argument('--optimizer', type=str, default='Adam')
     parser.add_argument('--weight_decay', type=float, default=1e-4)
     parser.add_argument('--criterion', type=str, default='API', help='API or bce')
+    parser.add_argument('--box_filter', type=str, default='sat',
+                        help='API loss box means: sat (summed-area table) or pool (avg_pool2d)')
     parser.add_argument('--scheduler', type=str, default='Reduce', help='Reduce or Step')
     parser.add_argument('--aug_ver', type=int, default=2, help='1=Normal, 2=Hard')
     parser.add_argument('--lr_factor', type=float, default=0.1)
@@ -30,15 +42,89 @@ def getConfig():
     parser.add_argument('--patience', type=int, default=5, help="Scheduler ReduceLROnPlateau's parameter & Early Stopping(+5)")
     parser.add_argument('--model_path', type=str, default='results')
     parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep_last', type=int, default=3, help='train: checkpoints of the most recent epochs to keep')
+    parser.add_argument('--keep_best', type=int, default=1, help='train: checkpoints of the lowest val loss epochs to keep')
+    parser.add_argument('--resume', type=str, default=None,
+                        help="train: <epoch>_checkpoint.pth to continue from, or 'latest' in the experiment folder")
     parser.add_argument('--save_map', type=bool, default=None, help='Save prediction map')
-    parser.add_argument('--output_path', type=str, default='pred_map', help='path where output files will be saved')
+    parser.add_argument('--output_path', type=str, default='pred_map', help='path where output files will be saved (test / apply maps, validation images during train)')
+    parser.add_argument('--input', type=str, default=None,
+                        help="apply: image folder, glob pattern or '-' to read paths from stdin (default: Test/images)")
+    parser.add_argument('--aspect_buckets', type=bool, default=False,
+                        help='test / apply: keep the aspect ratio (long side img_size, padded to a multiple of 32) '
+                             'and batch images by padded size')
+    parser.add_argument('--tiled', type=bool, default=False,
+                        help='apply: predict at native resolution from overlapping img_size tiles')
+    parser.add_argument('--tile_stride', type=int, default=None, help='apply --tiled: tile stride (default: 3/4 img_size)')
+    parser.add_argument('--global_weight', type=float, default=0.5,
+                        help='apply --tiled: weight of the global img_size pass in the blend (0 = tiles only)')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='test / apply / export / quantize: model weights (.pth or .safetensors), a TorchScript / ONNX export or an int8 model '
+                             '(apply, export, quantize default: <model_path>/best_model.pth)')
+    parser.add_argument('--export_format', type=str, default='torchscript', help='export: torchscript, onnx or safetensors (memory-mapped weights)')
+    parser.add_argument('--export_path', type=str, default=None,
+                        help='export / quantize: output file (default: <model_path>/TRACER-<arch>-<img_size>.torchscript.pt, .onnx, '
+                             '-int8.pth or TRACER-<arch>.safetensors)')
+    parser.add_argument('--ort_threads', type=int, default=0,
+                        help='apply with an .onnx checkpoint: ONNX Runtime intra-op threads (0 = all cores)')
+    parser.add_argument('--quant_engine', type=str, default='x86', help='quantize: int8 backend (x86, fbgemm or qnnpack)')
+    parser.add_argument('--calib_batches', type=int, default=32, help='quantize: calibration batches from the val split')
+    parser.add_argument('--num_writers', type=int, default=4, help='threads encoding and writing saved maps / cutouts')
+    parser.add_argument('--save_format', type=str, default='png', help='Saved map format (png, webp, npy)')
+    parser.add_argument('--save_level', type=int, default=None,
+                        help='PNG compression level (0-9) or WebP quality (1-100, >100 lossless)')
+
 
+    # Serving
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='serve / loadgen: address')
+    parser.add_argument('--port', type=int, default=8000, help='serve / loadgen: port')
+    parser.add_argument('--max_latency_ms', type=float, default=10,
+                        help='serve: longest wait for a micro-batch to fill (batch size: --batch_size)')
+    parser.add_argument('--url', type=str, default=None, help='loadgen: server URL (default: http://host:port)')
+    parser.add_argument('--num_requests', type=int, default=200, help='loadgen: timed requests')
+    parser.add_argument('--concurrency', type=int, default=16, help='loadgen: concurrent clients')
+    parser.add_argument('--serve_output', type=str, default='mask', help='loadgen: request mask or cutout')
+    parser.add_argument('--model_registry', type=str, default=None,
+                        help='serve: JSON {model_id: {"checkpoint": ..., "arch": ..., "img_size": ...}} of models to host')
+    parser.add_argument('--pool_device_mb', type=float, default=None,
+                        help='serve: device memory for warm models, least recently used ones move to host memory')
+    parser.add_argument('--pool_host_mb', type=float, default=None,
+                        help='serve: host memory for warm models, least recently used ones are unloaded')
+    parser.add_argument('--models', type=str, nargs='+', default=None,
+                        help='loadgen: model ids to spread the requests over (default: the server default)')
 
     # Hardware settings
     parser.add_argument('--multi_gpu', type=bool, default=True)
+    parser.add_argument('--distributed', type=bool, default=False,
+                        help='DistributedDataParallel instead of DataParallel, launch with torchrun')
+    parser.add_argument('--dist_backend', type=str, default=None, help='nccl or gloo (default: nccl if CUDA is available)')
     parser.add_argument('--num_workers', type=int, default=4)
-    cfg = parser.parse_args()
+    parser.add_argument('--amp', type=bool, default=False, help='Mixed-precision (autocast) training and inference')
+    parser.add_argument('--profile', type=str, default='deterministic',
+                        help='deterministic (reproducible, NCHW) or fast (channels_last + cudnn.benchmark)')
+    parser.add_argument('--bench_iters', type=int, default=20, help='benchmark: timed forward passes per profile')
+    parser.add_argument('--bench', type=str, default='profile',
+                        help='benchmark: profile (deterministic vs fast) or fold (BatchNorm folding at --bench_sizes)')
+    parser.add_argument('--bench_sizes', type=int, nargs='+', default=[320, 640], help='benchmark fold: input sizes')
+    parser.add_argument('--fold_bn', type=bool, default=False,
+                        help='test / apply / export: fold BatchNorm into the convolutions of a loaded checkpoint')
+    return parser
+
+
+def getConfig(argv=None):
+    """Parses argv (sys.argv[1:] by default). Nothing in the package calls this at import time:
+    the resulting config is passed to TRACER, Trainer, Tester, ... explicitly."""
+    return get_parser().parse_args(argv)
+
 
+def default_config(action='apply', **overrides):
+    """Config with every default and the given overrides, without reading sys.argv, e.g. for a server
+    that hosts several variants: TRACER(default_config(arch='7', img_size=640))."""
+    cfg = get_parser().parse_args([action])
+    for key, value in overrides.items():
+        if not hasattr(cfg, key):
+            raise AttributeError(f'Unknown config option {key!r}')
+        setattr(cfg, key, value)
     return cfg
 
 
@@ -1,16 +1,22 @@
+import os
 import cv2
 import glob
+import json
+import math
 import torch
 import numpy as np
 import albumentations as albu
 from pathlib import Path
 from albumentations.pytorch.transforms import ToTensorV2
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
 from sklearn.model_selection import train_test_split
 from torchvision import transforms
 import random
 import torchvision.transforms.functional as TF
 from PIL import Image
+from tqdm import tqdm
+from util.distributed import get_rank, get_world_size
 
 
 class DatasetGenerate(Dataset):
@@ -100,11 +106,148 @@ class DatasetGenerate(Dataset):
         return len(self.images)
 
 
+class PackedDatasetGenerate(Dataset):
+    """DatasetGenerate backed by a file written once with pack_dataset.
+
+    The shard holds every sample already decoded and resized to both sizes used by
+    DatasetGenerate.transform_random_crop, so __getitem__ only slices memory-mapped views and runs the
+    albumentations transform. Samples are stored in the same sorted order as DatasetGenerate, which
+    makes the seeded train/val split identical.
+    """
+    def __init__(self, packed_path, phase: str = 'train', transform=None, seed=None):
+        with open(packed_path + '.json') as f:
+            index = json.load(f)
+        self.packed_path = packed_path
+        self.sizes = index['sizes']
+        self.names = index['names']
+        self.org_sizes = index['org_sizes']
+        self.transform = transform
+        self.data = None  # opened lazily so every DataLoader worker maps the file itself
+
+        indices = list(range(len(self.names)))
+        train_indices, val_indices = train_test_split(indices, test_size=0.2, random_state=seed)
+        if phase == 'train':
+            self.indices = train_indices
+        elif phase == 'val':
+            self.indices = val_indices
+        else:  # Testset
+            self.indices = indices
+
+    def _arrays(self, idx, size):
+        if self.data is None:
+            self.data = np.memmap(self.packed_path + '.bin', dtype=np.uint8, mode='r')
+        offset = idx * sum(s * s * 5 for s in self.sizes)
+        for s in self.sizes[:self.sizes.index(size)]:
+            offset += s * s * 5
+        image = self.data[offset:offset + size * size * 3].reshape(size, size, 3)
+        offset += size * size * 3
+        mask = self.data[offset:offset + size * size].reshape(size, size)
+        offset += size * size
+        edge = self.data[offset:offset + size * size].reshape(size, size)
+        return image, mask, edge
+
+    def transform_random_crop(self, idx):
+        if random.random() > 0.3:
+            image, mask, edge = self._arrays(idx, 640)
+        else:
+            image, mask, edge = self._arrays(idx, 960)
+
+            # same draws as transforms.RandomCrop.get_params
+            i = torch.randint(0, 960 - 640 + 1, size=(1,)).item()
+            j = torch.randint(0, 960 - 640 + 1, size=(1,)).item()
+            image = image[i:i + 640, j:j + 640]
+            mask = mask[i:i + 640, j:j + 640]
+            edge = edge[i:i + 640, j:j + 640]
+
+        return image, mask, edge
+
+    def __getitem__(self, idx):
+        idx = self.indices[idx]
+        image_name = self.names[idx]
+        org_size = tuple(self.org_sizes[idx])
+        image, mask, edge = self.transform_random_crop(idx)
+
+        if self.transform is not None:
+            augmented = self.transform(image=image, masks=[mask, edge])
+            image = augmented['image']
+            mask = np.expand_dims(augmented['masks'][0], axis=0)  # (1, H, W)
+            mask = mask / 255.0
+            edge = np.expand_dims(augmented['masks'][1], axis=0)  # (1, H, W)
+            edge = edge / 255.0
+
+        return image, mask, edge, org_size, image_name
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def pack_dataset(img_folder, gt_folder, edge_folder, packed_path, sizes=(640, 960)):
+    """Decodes every image / mask / edge triplet once and writes it to `packed_path`.bin.
+
+    Each sample is stored as uint8 (image HxWx3, mask HxW, edge HxW) for every size in `sizes`, resized
+    with the same PIL bilinear filter as DatasetGenerate. `packed_path`.json keeps the sizes, the image
+    names and the original (H, W) of each sample.
+    """
+    images = sorted(glob.glob(img_folder + '/*'))
+    gts = sorted(glob.glob(gt_folder + '/*'))
+    edges = sorted(glob.glob(edge_folder + '/*'))
+    assert len(images) == len(gts) == len(edges), 'images, masks and edges must pair up'
+
+    os.makedirs(os.path.dirname(packed_path) or '.', exist_ok=True)
+    names, org_sizes = [], []
+    with open(packed_path + '.bin', 'wb') as f:
+        for image_file, gt_file, edge_file in tqdm(zip(images, gts, edges), total=len(images)):
+            image = Image.open(image_file).convert('RGB')
+            mask = Image.open(gt_file).convert('L')
+            edge = Image.open(edge_file).convert('L')
+            names.append(Path(image_file).stem)
+            org_sizes.append(image.size[::-1])
+
+            for size in sizes:
+                for item in (image, mask, edge):
+                    f.write(np.ascontiguousarray(item.resize((size, size), Image.BILINEAR)).tobytes())
+
+    with open(packed_path + '.json', 'w') as f:
+        json.dump({'sizes': list(sizes), 'names': names, 'org_sizes': org_sizes}, f)
+    print(f'packed {len(names)} samples to {packed_path}.bin')
+
+
+def letterbox_size(h, w, img_size, multiple=32):
+    """((h', w'), (H', W')): the size of an (h, w) image resized so its long side is img_size with the
+    aspect ratio kept, and that size padded up to a multiple of `multiple` for the network input."""
+    scale = img_size / max(h, w)
+    rh, rw = max(1, round(h * scale)), max(1, round(w * scale))
+    return (rh, rw), (math.ceil(rh / multiple) * multiple, math.ceil(rw / multiple) * multiple)
+
+
+def letterbox(image, img_size, transform=None):
+    """Resizes an RGB image with letterbox_size, applies transform (which must not resize) and zero-pads
+    the bottom and right of the resulting (C, h', w') tensor to the padded size."""
+    (rh, rw), (ph, pw) = letterbox_size(*image.shape[:2], img_size)
+    image = cv2.resize(image, (rw, rh), interpolation=cv2.INTER_LINEAR)
+    if transform is not None:
+        image = transform(image=image)['image']
+    return torch.nn.functional.pad(image, (0, pw - rw, 0, ph - rh))
+
+
+def prepare_image(orig_image, transform=None, letterbox_to=None):
+    """Network input for a decoded BGR image: transform, or letterbox to letterbox_to with transform."""
+    image = cv2.cvtColor(orig_image, cv2.COLOR_BGR2RGB)
+    if letterbox_to is not None:
+        return letterbox(image, letterbox_to, transform)
+    if transform is not None:
+        image = transform(image=image)['image']
+    return image
+
+
 class Test_DatasetGenerate(Dataset):
-    def __init__(self, img_folder, gt_folder, transform=None):
+    """With letterbox=img_size the images keep their aspect ratio (see letterbox) instead of being
+    squashed by a Resize in transform, which then only normalizes."""
+    def __init__(self, img_folder, gt_folder=None, transform=None, letterbox=None):
         self.images = sorted(glob.glob(img_folder + '/*'))
-        self.gts = sorted(glob.glob(gt_folder + '/*'))
+        self.gts = None if gt_folder is None else sorted(glob.glob(gt_folder + '/*'))
         self.transform = transform
+        self.letterbox = letterbox
 
     def __getitem__(self, idx):
         image_name = Path(self.images[idx]).stem
@@ -112,28 +255,123 @@ class Test_DatasetGenerate(Dataset):
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         original_size = image.shape[:2]
 
-        if self.transform is not None:
+        if self.letterbox is not None:
+            image = letterbox(image, self.letterbox, self.transform)
+        elif self.transform is not None:
             augmented = self.transform(image=image)
             image = augmented['image']
 
-        gt_image = None if self.gts is None else self.gts[idx]
-        return image, gt_image, original_size, image_name
+        if self.gts is None:
+            mask = np.zeros((1, 0, 0), dtype=np.uint8)  # no ground truth, empty placeholder for collate
+        else:
+            # Binarized like gt_to_tensor, kept as uint8 at the original size until it reaches the device
+            mask = cv2.imread(self.gts[idx])
+            mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
+            mask = np.expand_dims(np.uint8(mask > 127), axis=0)  # (1, H, W)
+
+        return image, mask, original_size, image_name
+
+    def original_sizes(self):
+        """(H, W) of every image, read from the file headers without decoding the pixels."""
+        return [image_size(path) for path in self.images]
 
     def __len__(self):
         return len(self.images)
 
 
+class Apply_DatasetGenerate(Dataset):
+    """Decode stage of the streaming apply pipeline.
+
+    Returns the normalized network input together with the decoded BGR original, so the cutout can
+    be built without reading the file a second time. Unreadable files yield None and are dropped by
+    apply_collate. letterbox works as in Test_DatasetGenerate.
+    """
+    def __init__(self, paths, transform=None, letterbox=None):
+        self.paths = paths
+        self.transform = transform
+        self.letterbox = letterbox
+
+    def __getitem__(self, idx):
+        orig_image = cv2.imread(self.paths[idx])
+        if orig_image is None:
+            return None
+        image = prepare_image(orig_image, self.transform, self.letterbox)
+
+        return image, orig_image, Path(self.paths[idx]).stem
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def apply_collate(batch):
+    # originals keep their own sizes, so only the network inputs are stacked
+    batch = [item for item in batch if item is not None]
+    if not batch:
+        return None
+    images, orig_images, image_names = zip(*batch)
+    return torch.stack(images), list(orig_images), list(image_names)
+
+
+class SizeGroupedBatchSampler(Sampler):
+    """Yields batches of indices whose images share the same original (H, W), or any other size key.
+
+    Predictions are resized back to the original resolution before evaluation, so grouping equal
+    sizes lets a whole batch be interpolated, compared against its masks and scored at once. Keyed by
+    the letterboxed input size it buckets images by aspect ratio and resolution, so a batch stacks.
+    Sizes keep the order of their first appearance and indices keep dataset order inside a size.
+    Under DDP each rank keeps every num_replicas-th batch.
+    """
+    def __init__(self, sizes, batch_size, rank=0, num_replicas=1):
+        self.batch_size = batch_size
+        groups = {}
+        for idx, size in enumerate(sizes):
+            groups.setdefault(tuple(size), []).append(idx)
+        self.batches = [indices[i:i + batch_size] for indices in groups.values()
+                        for i in range(0, len(indices), batch_size)]
+        self.batches = self.batches[rank::num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def image_size(path):
+    with Image.open(path) as image:
+        w, h = image.size
+        # cv2.imread applies the EXIF orientation, so transposed orientations swap the axes
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            h, w = w, h
+    return h, w
+
+
 def get_loader(img_folder, gt_folder: str, edge_folder, phase: str, batch_size, shuffle,
-               num_workers, transform, seed=None):
+               num_workers, transform, seed=None, packed_path=None, distributed=False, letterbox=None):
+    rank, num_replicas = (get_rank(), get_world_size()) if distributed else (0, 1)
     if phase == 'test':
-        dataset = Test_DatasetGenerate(img_folder, gt_folder, transform)
-        data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+        # batches share one original size, and with it one letterboxed size
+        dataset = Test_DatasetGenerate(img_folder, gt_folder, transform, letterbox)
+        batch_sampler = SizeGroupedBatchSampler(dataset.original_sizes(), batch_size, rank, num_replicas)
+        data_loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers,
+                                 pin_memory=torch.cuda.is_available())
     else:
-        dataset = DatasetGenerate(img_folder, gt_folder, edge_folder, phase, transform, seed)
-        data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
-                                 drop_last=True)
+        if packed_path is not None:
+            dataset = PackedDatasetGenerate(packed_path, phase, transform, seed)
+        else:
+            dataset = DatasetGenerate(img_folder, gt_folder, edge_folder, phase, transform, seed)
+        if distributed:
+            # every rank draws an equal, disjoint shard; Trainer calls set_epoch to reshuffle it
+            sampler = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle,
+                                         seed=seed or 0, drop_last=True)
+            data_loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers,
+                                     drop_last=True)
+        else:
+            data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                                     drop_last=True)
 
-    print(f'{phase} length : {len(dataset)}')
+    if rank == 0:
+        print(f'{phase} length : {len(dataset)}')
 
     return data_loader
 
@@ -182,11 +420,23 @@ def get_test_augmentation(img_size):
     return transforms
 
 
-def gt_to_tensor(gt):
+def get_normalize_augmentation():
+    # tiled and letterboxed inference size the image themselves, so the input is only normalized
+    transforms = albu.Compose([
+        albu.Normalize([0.485, 0.456, 0.406],
+                       [0.229, 0.224, 0.225]),
+        ToTensorV2(),
+    ])
+    return transforms
+
+
+def gt_to_tensor(gt, device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
     gt = cv2.imread(gt)
     gt = cv2.cvtColor(gt, cv2.COLOR_BGR2GRAY) / 255.0
     gt = np.where(gt > 0.5, 1.0, 0.0)
-    gt = torch.tensor(gt, device='cuda', dtype=torch.float32)
+    gt = torch.tensor(gt, device=device, dtype=torch.float32)
     gt = gt.unsqueeze(0).unsqueeze(1)
 
     return gt
@@ -135,11 +135,13 @@ def get_test_augmentation(img_size):
     return transforms
 
 
-def gt_to_tensor(gt):
+def gt_to_tensor(gt, device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
     gt = cv2.imread(gt)
     gt = cv2.cvtColor(gt, cv2.COLOR_BGR2GRAY) / 255.0
     gt = np.where(gt > 0.5, 1.0, 0.0)
-    gt = torch.tensor(gt, device='cuda', dtype=torch.float32)
+    gt = torch.tensor(gt, device=device, dtype=torch.float32)
     gt = gt.unsqueeze(0).unsqueeze(1)
 
     return gt
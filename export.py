@@ -0,0 +1,120 @@
+import copy
+import os
+import torch
+from inference import load_model
+from modules.att_modules import Frequency_Edge_Module
+from util.checkpoint import save_tensors
+
+
+def flatten(outputs):
+    if isinstance(outputs, (tuple, list)):
+        return [t for output in outputs for t in flatten(output)]
+    return [outputs]
+
+
+def max_abs_diff(eager_outputs, graph_outputs):
+    return max((a.float() - b.float()).abs().max().item()
+               for a, b in zip(flatten(eager_outputs), flatten(graph_outputs)))
+
+
+def export_torchscript(args, checkpoint, export_path, atol=1e-4):
+    """Traces TRACER at (img_size x img_size), freezes it and saves a self-contained TorchScript archive.
+
+    Tracing runs the Python forward once, so the EfficientNet block indices, the Frequency Edge Module's
+    high-pass filter for this input size and every shape check are baked into the graph as constants.
+    Freezing inlines the weights and folds batch norms into the convolutions. The archive is reloaded
+    the way load_model does it and compared with the eager model on fresh inputs of two batch sizes;
+    a mismatch above atol raises instead of leaving a bad export behind.
+
+    The result loads with torch.jit.load(path) (or torch::jit::load in C++) without this repository.
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = load_model(args, checkpoint, device)
+    model.model.set_swish(memory_efficient=False)  # the autograd.Function swish cannot be scripted
+
+    size = (3, args.img_size, args.img_size)
+    example = torch.rand(args.batch_size, *size, device=device)
+    with torch.no_grad():
+        graph = torch.jit.freeze(torch.jit.trace(model, example))
+
+    os.makedirs(os.path.dirname(os.path.abspath(export_path)), exist_ok=True)
+    torch.jit.save(graph, export_path)
+    graph = load_model(args, export_path, device)
+
+    with torch.no_grad():
+        for batch_size in (args.batch_size, 1):
+            inputs = torch.rand(batch_size, *size, device=device)
+            diff = max_abs_diff(model(inputs), graph(inputs))
+            if diff > atol:
+                os.remove(export_path)
+                raise RuntimeError(f'Exported graph differs from the eager model by {diff:.2e} (> {atol:.0e})')
+            print(f'Verified batch {batch_size}: max abs diff {diff:.2e}')
+
+    print(f'Exported TorchScript model to {export_path}')
+    return export_path
+
+
+def export_onnx(args, checkpoint, export_path, atol=1e-3):
+    """Exports TRACER at (img_size x img_size) to ONNX with a dynamic batch dimension.
+
+    ONNX has no complex tensors, so the Frequency Edge Module switches to its DFT-as-matrix-products
+    high pass; its DFT matrices and the shifted filter are fixed for the export size and become graph
+    constants. The file is then run through ONNX Runtime on the CPU (as apply does with an .onnx
+    checkpoint) and compared with the eager PyTorch model on two batch sizes.
+    """
+    device = torch.device('cpu')
+    model = load_model(args, checkpoint, device)
+    model.model.set_swish(memory_efficient=False)
+
+    size = (3, args.img_size, args.img_size)
+    output_names = ['mask', 'edge', 'ds_map0', 'ds_map1', 'ds_map2']
+    onnx_model = copy.deepcopy(model)
+    for module in onnx_model.modules():
+        if isinstance(module, Frequency_Edge_Module):
+            module.dft_matmul = True
+
+    os.makedirs(os.path.dirname(os.path.abspath(export_path)), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(onnx_model, torch.rand(args.batch_size, *size), export_path,
+                          input_names=['image'], output_names=output_names, opset_version=18,
+                          dynamic_axes={name: {0: 'batch'} for name in ['image'] + output_names})
+
+    graph = load_model(args, export_path, device)
+    with torch.no_grad():
+        for batch_size in (args.batch_size, 1):
+            inputs = torch.rand(batch_size, *size)
+            diff = max_abs_diff(model(inputs), graph(inputs))
+            if diff > atol:
+                os.remove(export_path)
+                raise RuntimeError(f'ONNX Runtime output differs from the eager model by {diff:.2e} (> {atol:.0e})')
+            print(f'Verified batch {batch_size}: max abs diff {diff:.2e}')
+
+    print(f'Exported ONNX model to {export_path}')
+    return export_path
+
+
+def export_safetensors(args, checkpoint, export_path, atol=0):
+    """Converts fp32 .pth weights to a memory-mappable .safetensors file without the 'module.' prefix.
+
+    load_model maps the file and assigns its tensors to a model built on the meta device, so a cold
+    start is bounded by reading the file instead of unpickling it into a second copy of the weights.
+    Both models are compared on the same inputs; the weights are copied bit for bit, so any difference
+    above atol raises.
+    """
+    device = torch.device('cpu')
+    eager_args = copy.copy(args)
+    eager_args.fold_bn = False
+    model = load_model(eager_args, checkpoint, device)
+    os.makedirs(os.path.dirname(os.path.abspath(export_path)), exist_ok=True)
+    save_tensors(model.state_dict(), export_path, metadata={'arch': args.arch, 'img_size': args.img_size})
+    mapped = load_model(eager_args, export_path, device)
+
+    with torch.no_grad():
+        inputs = torch.rand(args.batch_size, 3, args.img_size, args.img_size, device=device)
+        diff = max_abs_diff(model(inputs), mapped(inputs))
+    if diff > atol:
+        os.remove(export_path)
+        raise RuntimeError(f'Memory-mapped model differs from the .pth model by {diff:.2e}')
+    print(f'Verified batch {args.batch_size}: max abs diff {diff:.2e}')
+    print(f'Exported safetensors weights to {export_path}')
+    return export_path
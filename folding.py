@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from model.EfficientNet import EfficientNet, MBConvBlock
+from modules.att_modules import UnionAttentionModule
+from modules.conv_modules import BasicConv2d, DWConv, DWSConv
+
+# (conv, bn) attribute pairs that run back to back in each module's forward
+CONV_BN_PAIRS = {
+    BasicConv2d: [('conv', 'bn')],
+    DWConv: [('DWConv', 'bn')],
+    DWSConv: [('DWConv', 'bn'), ('PWConv', 'bn2')],
+    MBConvBlock: [('_expand_conv', '_bn0'), ('_depthwise_conv', '_bn1'), ('_project_conv', '_bn2')],
+    EfficientNet: [('_conv_stem', '_bn0'), ('_conv_head', '_bn1')],
+}
+
+
+def fold_norm_into_conv(bn, conv):
+    """conv(bn(x)) as a single conv for a 1x1, unpadded conv that follows an eval-mode BatchNorm."""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    folded = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=1, bias=True).to(conv.weight.device)
+    folded.weight.data = conv.weight * scale.view(1, -1, 1, 1)
+    folded.bias.data = conv.weight.flatten(1) @ shift + (conv.bias if conv.bias is not None else 0)
+    return folded
+
+
+def fold_batchnorm(model):
+    """Folds every BatchNorm of an eval-mode TRACER into the neighbouring convolution.
+
+    BasicConv2d, DWConv, DWSConv, MBConvBlock and the EfficientNet stem / head get their BN folded into
+    the preceding conv (w' = w * g / sqrt(var + eps), b' = (b - mean) * g / sqrt(var + eps) + beta), and
+    the BN that normalizes the pooled features in front of UnionAttentionModule's 1x1 q / k / v convs is
+    folded into those convs. Each folded BN is replaced by nn.Identity.
+
+    The result is inference-only: the folded weights no longer match the training parametrization,
+    so gradients are switched off. UnionAttentionModule.bn stays, since a per-sample channel mask sits
+    between it and the next conv.
+    """
+    model.eval()
+    with torch.no_grad():
+        for module in list(model.modules()):
+            for conv_name, bn_name in CONV_BN_PAIRS.get(type(module), ()):
+                conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+                if conv is not None and isinstance(bn, nn.BatchNorm2d):
+                    setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                    setattr(module, bn_name, nn.Identity())
+
+            if isinstance(module, UnionAttentionModule) and isinstance(module.norm[0], nn.BatchNorm2d):
+                bn = module.norm[0]
+                module.channel_q = fold_norm_into_conv(bn, module.channel_q)
+                module.channel_k = fold_norm_into_conv(bn, module.channel_k)
+                module.channel_v = fold_norm_into_conv(bn, module.channel_v)
+                module.norm = nn.Identity()  # the Dropout3d behind it is a no-op in eval
+
+    model.requires_grad_(False)
+    return model
@@ -0,0 +1,336 @@
+import os
+import sys
+import copy
+import glob
+import time
+import zipfile
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from custom_dataloader import get_test_augmentation, get_normalize_augmentation, Apply_DatasetGenerate, apply_collate, \
+    SizeGroupedBatchSampler, image_size, letterbox_size
+from folding import fold_batchnorm
+from model.TRACER import TRACER
+from postprocessing import PostProcess
+from quantization import QuantizedUnit, is_quantized, load_quantized
+from tiling import tiled_predict
+from util.checkpoint import is_tensor_file, is_training_checkpoint, load_into_meta, normalize_keys
+from util.output_sink import get_sink
+from util.performance import PROFILES, set_performance_profile, memory_format
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def collect_inputs(source):
+    """Image paths from a directory, a glob pattern, or '-' for one path per line on stdin."""
+    if source == '-':
+        return [line.strip() for line in sys.stdin if line.strip()]
+    if os.path.isdir(source):
+        return sorted(path for path in glob.glob(os.path.join(source, '*'))
+                      if path.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(glob.glob(source, recursive=True))
+
+
+def is_torchscript(path):
+    """TorchScript archives carry their code next to the weights, plain state dicts do not."""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any('/code/' in name for name in archive.namelist())
+
+
+class OnnxRuntimeModel():
+    """Runs an exported TRACER ONNX graph on the CPU with ONNX Runtime, behind the same call signature as
+    the PyTorch model: (B, 3, H, W) tensor in, (mask, edge, (ds_map0, ds_map1, ds_map2)) tensors out."""
+    def __init__(self, onnx_path, num_threads=0):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError('ONNX Runtime inference needs the onnxruntime package (pip install onnxruntime)') from e
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads  # 0 lets ONNX Runtime use every physical core
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, images):
+        outputs = self.session.run(None, {self.input_name: images.detach().cpu().float().numpy()})
+        outputs = [torch.from_numpy(output) for output in outputs]
+        return outputs[0], outputs[1], tuple(outputs[2:])
+
+
+def unpad_resize(outputs, valid_sizes, sizes):
+    """Crops each (1, PH, PW) prediction of the batch to its valid (h, w) region and resizes it to its
+    original (H, W). Predictions that share both sizes go through a single interpolate call.
+    Returns a list of (1, H, W) tensors in batch order."""
+    groups = {}
+    for i, key in enumerate(zip(valid_sizes, sizes)):
+        groups.setdefault(key, []).append(i)
+
+    resized = [None] * len(sizes)
+    for ((h, w), size), indices in groups.items():
+        group = outputs[indices] if len(indices) < outputs.size(0) else outputs
+        group = F.interpolate(group[:, :, :h, :w], size=size, mode='bilinear')
+        for i, output in zip(indices, group):
+            resized[i] = output
+    return resized
+
+
+def letterbox_key(path, img_size):
+    # padded input size for the bucketing sampler; unreadable files are dropped later by apply_collate
+    try:
+        return letterbox_size(*image_size(path), img_size)[1]
+    except OSError:
+        return (0, 0)
+
+
+def is_cpu_only(model):
+    """ONNX Runtime sessions and int8 models only have CPU kernels."""
+    return isinstance(model, OnnxRuntimeModel) or any(isinstance(m, QuantizedUnit) for m in model.modules())
+
+
+def is_movable(model):
+    """Whether model.to(device) moves the model: not for CPU-only models, nor for TorchScript graphs,
+    which are frozen and optimized for the device they were loaded on."""
+    return not isinstance(model, torch.jit.ScriptModule) and not is_cpu_only(model)
+
+
+def load_model(args, checkpoint, device):
+    if checkpoint.endswith('.onnx'):
+        # written by export --export_format onnx, always runs on the CPU
+        return OnnxRuntimeModel(checkpoint, num_threads=args.ort_threads)
+    if is_torchscript(checkpoint):
+        # written by the export action: a frozen graph for a fixed img_size, no model code needed.
+        # optimize_for_inference specializes it to this device (fusions, prepacked weights) and
+        # cannot be serialized, so it runs at load time
+        return torch.jit.optimize_for_inference(torch.jit.load(checkpoint, map_location=device).eval())
+    if is_tensor_file(checkpoint):
+        # memory-mapped weights assigned to a model built on the meta device: no random initialization
+        # and no deserialized copy, loading is reading the pages of the file
+        model = load_into_meta(lambda: TRACER(args, pretrained=False), checkpoint, device)
+        model = model.to(memory_format=memory_format(args.profile))
+        return fold_batchnorm(model) if args.fold_bn else model.eval()
+    # fp32 weights, int8 checkpoints (quantized tensors) and training checkpoints are all plain tensor
+    # containers, so no file is allowed to run pickled code
+    state_dict = torch.load(checkpoint, map_location=device, weights_only=True)
+    if is_quantized(state_dict):
+        # written by the quantize action: int8 units, runs on the CPU
+        return load_quantized(args, state_dict)
+    if is_training_checkpoint(state_dict):
+        state_dict = state_dict['model']  # an <epoch>_checkpoint.pth of the training run
+    model = TRACER(args, pretrained=False).to(device, memory_format=memory_format(args.profile))
+    # Checkpoints saved from nn.DataParallel / DDP carry a 'module.' prefix
+    model.load_state_dict(normalize_keys(state_dict))
+    if args.fold_bn:
+        return fold_batchnorm(model)
+    return model.eval()
+
+
+def forward_throughput(model, images, iters, warmup=5, amp=False):
+    """Images per second of model on images, after warmup untimed passes."""
+    cuda = images.device.type == 'cuda'
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=amp):
+        for i in range(warmup + iters):
+            if i == warmup:
+                if cuda:
+                    torch.cuda.synchronize()
+                t = time.time()
+            model(images)
+        if cuda:
+            torch.cuda.synchronize()
+    return iters * images.size(0) / (time.time() - t)
+
+
+def benchmark_profiles(args, iters=20, warmup=5):
+    """Forward throughput of every performance profile on a fixed (batch_size, 3, img_size, img_size) input.
+
+    The same weights are reused, only the memory format and the cuDNN settings change between runs.
+    Returns {profile: images per second} and prints the speedup of 'fast' over 'deterministic'.
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    amp = bool(args.amp) and device.type == 'cuda'
+    model = TRACER(args).to(device).eval()
+    images = torch.rand(args.batch_size, 3, args.img_size, args.img_size, device=device)
+
+    results = {}
+    for profile in PROFILES:
+        set_performance_profile(profile)
+        model = model.to(memory_format=memory_format(profile))
+        x = images.contiguous(memory_format=memory_format(profile))
+        results[profile] = forward_throughput(model, x, iters, warmup, amp)
+        print(f'{profile:>13}: {results[profile]:.2f} img/s')
+
+    print(f'Speedup (fast / deterministic): {results["fast"] / results["deterministic"]:.2f}x')
+    set_performance_profile(args.profile)
+    return results
+
+
+def benchmark_folding(args, sizes=(320, 640), iters=20, warmup=5):
+    """Forward latency of the eval model before and after fold_batchnorm at every input size in sizes.
+
+    Both models share one initialization under the current --profile; the folded outputs are checked
+    against the unfolded ones. Returns {size: (ms/img unfolded, ms/img folded)}.
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    amp = bool(args.amp) and device.type == 'cuda'
+    model = TRACER(args).to(device, memory_format=memory_format(args.profile)).eval()
+    folded = fold_batchnorm(copy.deepcopy(model))
+
+    results = {}
+    for size in sizes:
+        images = torch.rand(args.batch_size, 3, size, size, device=device)
+        images = images.contiguous(memory_format=memory_format(args.profile))
+        with torch.no_grad():
+            diff = max((a - b).abs().max().item() for a, b in zip(model(images)[:2], folded(images)[:2]))
+        base = 1000 / forward_throughput(model, images, iters, warmup, amp)
+        fast = 1000 / forward_throughput(folded, images, iters, warmup, amp)
+        results[size] = (base, fast)
+        print(f'{size:>5}px: {base:.1f} -> {fast:.1f} ms/img ({base / fast:.2f}x, max abs diff {diff:.1e})')
+    return results
+
+
+def input_transform(args):
+    """(transform, letterbox size or None) that turns a decoded image into the network input for args."""
+    if args.aspect_buckets:
+        return get_normalize_augmentation(), args.img_size
+    return get_test_augmentation(img_size=args.img_size), None
+
+
+class StreamingApply():
+    """Foreground extraction over an arbitrary number of images with a single model load.
+
+    Three stages joined by bounded queues:
+        decode   - DataLoader workers read and preprocess images (prefetch_factor batches each),
+        forward  - the main thread runs batched inference and resizes each mask on the device,
+        encode   - the OutputSink writer threads build the cutout, composite it and write the file.
+    The sink holds at most `max_pending` images, so a slow disk throttles the GPU loop instead of
+    growing memory without bound.
+
+    With args.aspect_buckets the images keep their aspect ratio: the long side is resized to img_size,
+    the input padded to a multiple of 32 and batches are bucketed by that padded size.
+    """
+    def __init__(self, args, checkpoint):
+        self.args = args
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.transform, self.letterbox = input_transform(args)
+        self.post_process = PostProcess()
+        self.model = load_model(args, checkpoint, self.device)
+        if is_cpu_only(self.model):
+            self.device = torch.device('cpu')
+        self.amp = bool(args.amp) and self.device.type == 'cuda'
+        self.memory_format = memory_format(args.profile)
+        self.max_pending = 4 * args.num_writers * args.batch_size
+
+    def to(self, device):
+        """Moves the model to device (ONNX Runtime, int8 and TorchScript models stay where they are)."""
+        if is_movable(self.model):
+            self.model = self.model.to(device)
+            self.device = device
+            self.amp = bool(self.args.amp) and device.type == 'cuda'
+        return self
+
+    @staticmethod
+    def apply_mask(image: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        b, g, r = cv2.split(image)
+        output_mask = cv2.merge([b, g, r, mask], 4)
+
+        return output_mask
+
+    def cutout(self, orig_image, pred_mask):
+        output_image = self.apply_mask(image=orig_image, mask=pred_mask)
+        h, w = orig_image.shape[:2]
+        return self.post_process.postprocess(output_image, w, h)
+
+    def predict(self, images, sizes):
+        """uint8 masks at the original (h, w) sizes for a batch of preprocessed (B, 3, H, W) inputs."""
+        images = images.to(self.device, dtype=torch.float32, memory_format=self.memory_format, non_blocking=True)
+        with torch.cuda.amp.autocast(enabled=self.amp):
+            outputs, edge_mask, ds_map = self.model(images)
+        outputs = outputs.float()
+
+        if self.letterbox is None:
+            valid_sizes = [tuple(outputs.size()[-2:])] * len(sizes)
+        else:
+            valid_sizes = [letterbox_size(h, w, self.letterbox)[0] for h, w in sizes]
+        pred_masks = unpad_resize(outputs, valid_sizes, sizes)
+        return [(pred_mask.squeeze(0) * 255.0).to(torch.uint8).cpu().numpy()   # convert uint8 type
+                for pred_mask in pred_masks]
+
+    def run(self, paths, output_path):
+        dataset = Apply_DatasetGenerate(paths, self.transform, letterbox=self.letterbox)
+        if self.letterbox is None:
+            loader = DataLoader(dataset, batch_size=self.args.batch_size, shuffle=False,
+                                num_workers=self.args.num_workers, collate_fn=apply_collate,
+                                pin_memory=self.device.type == 'cuda')
+        else:
+            sampler = SizeGroupedBatchSampler([letterbox_key(path, self.letterbox) for path in paths],
+                                              self.args.batch_size)
+            loader = DataLoader(dataset, batch_sampler=sampler, num_workers=self.args.num_workers,
+                                collate_fn=apply_collate, pin_memory=self.device.type == 'cuda')
+        sink = get_sink(self.args, output_path, max_pending=self.max_pending)
+        t = time.time()
+        count = 0
+
+        with sink, torch.no_grad():
+            for batch in tqdm(loader):
+                if batch is None:
+                    continue
+                images, orig_images, image_names = batch
+                pred_masks = self.predict(images, [orig_image.shape[:2] for orig_image in orig_images])
+                for image_name, orig_image, pred_mask in zip(image_names, orig_images, pred_masks):
+                    sink.submit(image_name, orig_image, pred_mask, fn=self.cutout)
+                count += len(orig_images)
+
+        elapsed = time.time() - t
+        print(f'Applied {count} images in {elapsed:.3f}s ({count / max(elapsed, 1e-9):.2f} img/s)')
+        return count
+
+
+class TiledApply(StreamingApply):
+    """Foreground extraction at native resolution for images much larger than img_size.
+
+    Instead of resizing the whole image to (img_size x img_size), every image is decoded at full
+    resolution and predicted with tiled_predict: overlapping img_size tiles every tile_stride pixels,
+    feather-blended, plus an optional global pass at img_size for context. The loader yields one
+    image at a time; args.batch_size is the number of tiles per forward pass.
+    """
+    def __init__(self, args, checkpoint):
+        super(TiledApply, self).__init__(args, checkpoint)
+        self.transform = get_normalize_augmentation()
+        self.tile = args.img_size
+        self.stride = args.tile_stride or args.img_size * 3 // 4
+        if not 0 < self.stride <= self.tile:
+            raise ValueError(f'tile_stride must be in (0, {self.tile}], got {self.stride}')
+        self.max_pending = 4 * args.num_writers
+
+    def run(self, paths, output_path):
+        loader = DataLoader(Apply_DatasetGenerate(paths, self.transform), batch_size=1, shuffle=False,
+                            num_workers=self.args.num_workers, collate_fn=apply_collate,
+                            pin_memory=self.device.type == 'cuda')
+        sink = get_sink(self.args, output_path, max_pending=self.max_pending)
+        t = time.time()
+        count = 0
+
+        with sink, torch.no_grad():
+            for batch in tqdm(loader):
+                if batch is None:
+                    continue
+                images, orig_images, image_names = batch
+                images = images.to(self.device, dtype=torch.float32, non_blocking=True)
+                pred_mask = tiled_predict(self.model, images, self.tile, self.stride, self.args.batch_size,
+                                          global_size=self.args.img_size, global_weight=self.args.global_weight,
+                                          amp=self.amp, memory_format=self.memory_format)
+                pred_mask = (pred_mask.squeeze() * 255.0).to(torch.uint8).cpu().numpy()
+                sink.submit(image_names[0], orig_images[0], pred_mask, fn=self.cutout)
+                count += 1
+
+        elapsed = time.time() - t
+        print(f'Applied {count} images in {elapsed:.3f}s ({count / max(elapsed, 1e-9):.2f} img/s)')
+        return count
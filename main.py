@@ -8,13 +8,20 @@ import warnings
 import torch
 import numpy as np
 from trainer import Trainer, Tester
+from custom_dataloader import pack_dataset
+from inference import StreamingApply, TiledApply, collect_inputs, benchmark_profiles, benchmark_folding
+from export import export_torchscript, export_onnx, export_safetensors
+from quantization import run_quantization
+from server import serve, load_test
+from util.distributed import cleanup_distributed, is_main_process
+from util.performance import set_performance_profile
+from util.weight_store import set_store_dir, prewarm
 from shutil import copyfile
 from config import getConfig
 warnings.filterwarnings('ignore')
-cfg = getConfig()
 
 
-def prepare_trained_model_file() -> str:
+def prepare_trained_model_file(cfg) -> str:
     trained_model_path = os.path.join(cfg.model_path, cfg.dataset, f"TE{cfg.arch}_0")
     os.makedirs(trained_model_path, exist_ok=True)
     trained_model_file = os.path.join(cfg.model_path, f"copy_model.pth")
@@ -34,8 +41,10 @@ def main(cfg):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)  # if use multi-GPU
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    # cuDNN determinism vs autotuning is chosen with --profile
+    set_performance_profile(cfg.profile)
+    if cfg.weights_dir is not None:
+        set_store_dir(cfg.weights_dir)
 
     # save_path = os.path.join(cfg.model_path)
     save_path = cfg.model_path
@@ -44,26 +53,64 @@ def main(cfg):
         os.makedirs(save_path, exist_ok=True)
         Trainer(cfg, save_path)
     elif cfg.action == 'test':
+        # saved maps go to <output_path>/<model_name>
+        if cfg.checkpoint is not None:
+            model_name = os.path.splitext(os.path.basename(cfg.checkpoint))[0]
+        else:
+            model_name = f'TE{cfg.arch}_{cfg.exp_num}'
         datasets = ['car_data']
         for dataset in datasets:
             cfg.dataset = dataset
-            test_loss, test_mae, test_maxf, test_avgf, test_s_m = Tester(cfg, save_path).test()
+            test_loss, test_mae, test_maxf, test_avgf, test_s_m = Tester(cfg, save_path, model_name).test()
 
-            print(f'Test Loss:{test_loss:.3f} | MAX_F:{test_maxf:.4f} '
-                  f'| AVG_F:{test_avgf:.4f} | MAE:{test_mae:.4f} | S_Measure:{test_s_m:.4f}')
+            if is_main_process():
+                print(f'Test Loss:{test_loss:.3f} | MAX_F:{test_maxf:.4f} '
+                      f'| AVG_F:{test_avgf:.4f} | MAE:{test_mae:.4f} | S_Measure:{test_s_m:.4f}')
     elif cfg.action == 'apply':
-        # trained_model_path = prepare_trained_model_file()
-        # Tester(cfg,"./results/", "model_weights_25.pth", have_gt=False).test()
-#         for model_name in os.listdir("./results/"):
-#             print(f'Model ---> {model_name}')
-        model_name = '/content/TRACER/results/best_model.pth'
-        Tester(cfg, save_path, model_name, have_gt=False).test()
-        # print(trained_model_path)
-        # input('')
-        # shutil.rmtree(trained_model_path)
+        checkpoint = cfg.checkpoint or os.path.join(save_path, 'best_model.pth')
+        source = cfg.input or os.path.join(cfg.data_path, cfg.dataset, 'Test/images/')
+        runner = TiledApply if cfg.tiled else StreamingApply
+        runner(cfg, checkpoint).run(collect_inputs(source), cfg.output_path)
+    elif cfg.action == 'pack':
+        tr_folder = os.path.join(cfg.data_path, cfg.dataset, 'Train')
+        packed_path = cfg.packed_data or os.path.join(tr_folder, 'packed')
+        pack_dataset(os.path.join(tr_folder, 'images/'), os.path.join(tr_folder, 'masks/'),
+                     os.path.join(tr_folder, 'edges/'), packed_path)
+    elif cfg.action == 'benchmark':
+        if cfg.bench == 'fold':
+            benchmark_folding(cfg, sizes=cfg.bench_sizes, iters=cfg.bench_iters)
+        else:
+            benchmark_profiles(cfg, iters=cfg.bench_iters)
+    elif cfg.action == 'export':
+        checkpoint = cfg.checkpoint or os.path.join(save_path, 'best_model.pth')
+        if cfg.export_format == 'onnx':
+            export_path = cfg.export_path or os.path.join(save_path, f'TRACER-{cfg.arch}-{cfg.img_size}.onnx')
+            export_onnx(cfg, checkpoint, export_path)
+        elif cfg.export_format == 'safetensors':
+            export_path = cfg.export_path or os.path.join(save_path, f'TRACER-{cfg.arch}.safetensors')
+            export_safetensors(cfg, checkpoint, export_path)
+        else:
+            export_path = cfg.export_path or os.path.join(save_path, f'TRACER-{cfg.arch}-{cfg.img_size}.torchscript.pt')
+            export_torchscript(cfg, checkpoint, export_path)
+    elif cfg.action == 'quantize':
+        checkpoint = cfg.checkpoint or os.path.join(save_path, 'best_model.pth')
+        output_file = cfg.export_path or os.path.join(save_path, f'TRACER-{cfg.arch}-{cfg.img_size}-int8.pth')
+        run_quantization(cfg, checkpoint, output_file)
+    elif cfg.action == 'prewarm':
+        # fill the pretrained weight store, e.g. before copying it to offline nodes
+        prewarm([f'efficientnet-b{arch}' for arch in cfg.prewarm_archs or [cfg.arch]], source=cfg.weights_source,
+                variants=cfg.prewarm_variants)
+    elif cfg.action == 'serve':
+        serve(cfg, cfg.checkpoint or os.path.join(save_path, 'best_model.pth'))
+    elif cfg.action == 'loadgen':
+        # against a running serve, with the images of --input
+        load_test(cfg)
     else:
-        raise ValueError("action should be train, test or apply.")
+        raise ValueError("action should be train, test, apply, pack, benchmark, export, quantize, prewarm, "
+                         "serve or loadgen.")
+
+    cleanup_distributed()
 
 
 if __name__ == '__main__':
-    main(cfg)
+    main(getConfig())
@@ -25,9 +25,6 @@ from util.effi_utils import (
     calculate_output_image_size
 )
 from modules.att_modules import Frequency_Edge_Module
-from config import getConfig
-
-cfg = getConfig()
 
 VALID_MODELS = (
     'efficientnet-b0', 'efficientnet-b1', 'efficientnet-b2', 'efficientnet-b3',
@@ -147,15 +144,17 @@ class MBConvBlock(nn.Module):
 
 
 class EfficientNet(nn.Module):
-    def __init__(self, blocks_args=None, global_params=None):
+    def __init__(self, blocks_args=None, global_params=None, cfg=None):
         super().__init__()
         assert isinstance(blocks_args, list), 'blocks_args should be a list'
         assert len(blocks_args) > 0, 'block args must be greater than 0'
         self._global_params = global_params
         self._blocks_args = blocks_args
-        self.block_idx, self.channels = get_model_shape()
+        assert cfg is not None, 'the TRACER config (arch, frequency_radius, gamma) is required'
+        self.block_idx, self.channels = get_model_shape(cfg.arch)
         self.Frequency_Edge_Module1 = Frequency_Edge_Module(radius=cfg.frequency_radius,
-                                                            channel=self.channels[0])
+                                                            channel=self.channels[0],
+                                                            confidence_ratio=cfg.gamma)
         # Batch norm parameters
         bn_mom = 1 - self._global_params.batch_norm_momentum
         bn_eps = self._global_params.batch_norm_epsilon
@@ -244,27 +243,29 @@ class EfficientNet(nn.Module):
 
             x = block(x, drop_connect_rate=drop_connect_rate)
 
+            # No block modifies its input in place, so the features are kept by reference
             if idx == self.block_idx[0]:
                 x, edge = self.Frequency_Edge_Module1(x)
                 edge = F.interpolate(edge, size=(H, W), mode='bilinear')
-                x1 = x.clone()
+                x1 = x
             if idx == self.block_idx[1]:
-                x2 = x.clone()
+                x2 = x
             if idx == self.block_idx[2]:
-                x3 = x.clone()
+                x3 = x
             if idx == self.block_idx[3]:
-                x4 = x.clone()
+                x4 = x
 
         return (x1, x2, x3, x4), edge
 
 
     @classmethod
-    def from_name(cls, model_name, in_channels=3, **override_params):
+    def from_name(cls, model_name, in_channels=3, cfg=None, **override_params):
         """create an efficientnet model according to name.
 
         Args:
             model_name (str): Name for efficientnet.
             in_channels (int): Input data's channel number.
+            cfg (Namespace): TRACER config (arch, frequency_radius, gamma).
             override_params (other key word params):
                 Params to override model's global_params.
                 Optional key:
@@ -279,13 +280,13 @@ class EfficientNet(nn.Module):
         """
         cls._check_model_name_is_valid(model_name)
         blocks_args, global_params = get_model_params(model_name, override_params)
-        model = cls(blocks_args, global_params)
+        model = cls(blocks_args, global_params, cfg)
         model._change_in_channels(in_channels)
         return model
 
     @classmethod
     def from_pretrained(cls, model_name, weights_path=None, advprop=False,
-                        in_channels=3, num_classes=1000, **override_params):
+                        in_channels=3, num_classes=1000, cfg=None, **override_params):
         """create an efficientnet model according to name.
 
         Args:
@@ -300,6 +301,7 @@ class EfficientNet(nn.Module):
             num_classes (int):
                 Number of categories for classification.
                 It controls the output size for final linear layer.
+            cfg (Namespace): TRACER config (arch, frequency_radius, gamma).
             override_params (other key word params):
                 Params to override model's global_params.
                 Optional key:
@@ -312,7 +314,7 @@ class EfficientNet(nn.Module):
         Returns:
             A pretrained TRACER-EfficientNet model.
         """
-        model = cls.from_name(model_name, num_classes=num_classes, **override_params)
+        model = cls.from_name(model_name, num_classes=num_classes, cfg=cfg, **override_params)
         load_pretrained_weights(model, model_name, weights_path=weights_path, advprop=advprop)
         model._change_in_channels(in_channels)
         return model
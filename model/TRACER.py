@@ -12,10 +12,14 @@ from modules.att_modules import RFB_Block, aggregation, ObjectAttention
 
 
 class TRACER(nn.Module):
-    def __init__(self, cfg):
+    def __init__(self, cfg, pretrained=True):
         super().__init__()
-        self.model = EfficientNet.from_pretrained(f'efficientnet-b{cfg.arch}', advprop=True)
-        self.block_idx, self.channels = get_model_shape()
+        if pretrained:
+            self.model = EfficientNet.from_pretrained(f'efficientnet-b{cfg.arch}', advprop=True, cfg=cfg)
+        else:
+            # the weights come from a TRACER checkpoint right after, skip the ImageNet backbone load
+            self.model = EfficientNet.from_name(f'efficientnet-b{cfg.arch}', cfg=cfg)
+        self.block_idx, self.channels = get_model_shape(cfg.arch)
 
         # Receptive Field Blocks
         channels = [int(arg_c) for arg_c in cfg.RFB_aggregated_channel]
@@ -24,11 +28,11 @@ class TRACER(nn.Module):
         self.rfb4 = RFB_Block(self.channels[3], channels[2])
 
         # Multi-level aggregation
-        self.agg = aggregation(channels)
+        self.agg = aggregation(channels, confidence_ratio=cfg.gamma)
 
         # Object Attention
-        self.ObjectAttention2 = ObjectAttention(channel=self.channels[1], kernel_size=3)
-        self.ObjectAttention1 = ObjectAttention(channel=self.channels[0], kernel_size=3)
+        self.ObjectAttention2 = ObjectAttention(channel=self.channels[1], kernel_size=3, denoise=cfg.denoise)
+        self.ObjectAttention1 = ObjectAttention(channel=self.channels[0], kernel_size=3, denoise=cfg.denoise)
 
     def forward(self, inputs):
         B, C, H, W = inputs.size()
@@ -0,0 +1,168 @@
+import copy
+import json
+import os
+import threading
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from inference import StreamingApply, is_cpu_only, is_movable
+
+
+class UnknownModel(KeyError):
+    """A model id that is not in the pool's registry."""
+
+
+def model_nbytes(runner, checkpoint):
+    """Resident size of a loaded model: its parameters and buffers, the file size for ONNX Runtime."""
+    if isinstance(runner.model, nn.Module):
+        tensors = list(runner.model.parameters()) + list(runner.model.buffers())
+        if tensors:
+            return sum(t.numel() * t.element_size() for t in tensors)
+    return os.path.getsize(checkpoint)
+
+
+def read_registry(path):
+    """{model_id: {'checkpoint': ..., config overrides such as 'arch' or 'img_size'}} from a JSON file."""
+    with open(path) as f:
+        registry = json.load(f)
+    for model_id, spec in registry.items():
+        if 'checkpoint' not in spec:
+            raise ValueError(f'Model {model_id!r} in {path} has no checkpoint')
+    return registry
+
+
+class ModelPool():
+    """Keeps several TRACER checkpoints warm and routes work to them by model id.
+
+    Loaded models live in two LRU tiers: the inference device (with CUDA) and host memory. A model
+    that no longer fits the device budget is moved to host memory, where getting it back is a
+    .to(device) copy rather than a rebuild and load_state_dict; one that no longer fits the host
+    budget is dropped and reloaded from its checkpoint on the next request. Without CUDA both tiers
+    are host memory, so there is one tier under host_budget. The most recently used model is never
+    evicted, even if it alone exceeds a budget. A budget of None is unlimited.
+
+    Models that only run on the CPU (ONNX Runtime, int8) live in the host tier and are served from
+    there, outside the device budget. TorchScript graphs are frozen for the device they were loaded
+    on, so they are dropped rather than moved when they leave the device tier.
+
+    Each entry is a StreamingApply runner built with the base config plus the model's overrides,
+    so every id can use its own arch, img_size, checkpoint format, fold_bn, ...
+    """
+    def __init__(self, args, registry, device_budget=None, host_budget=None):
+        self.args = args
+        self.registry = registry
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.two_tiers = self.device.type == 'cuda'
+        self.device_budget = device_budget if self.two_tiers else host_budget
+        self.host_budget = host_budget
+        self.device_models = OrderedDict()  # model id -> (runner, nbytes), least recently used first
+        self.host_models = OrderedDict()
+        self.loads = 0
+        self.lock = threading.RLock()
+
+    @property
+    def model_ids(self):
+        return list(self.registry)
+
+    def config(self, model_id):
+        if model_id not in self.registry:
+            raise UnknownModel(f'Unknown model id {model_id!r}, expected one of {self.model_ids}')
+        args = copy.copy(self.args)
+        for key, value in self.registry[model_id].items():
+            if key != 'checkpoint':
+                setattr(args, key, value)
+        return args
+
+    def get(self, model_id):
+        """Runner for model_id with its model on the inference device, loading or promoting it."""
+        with self.lock:
+            if model_id in self.device_models:
+                self.device_models.move_to_end(model_id)
+                return self.device_models[model_id][0]
+
+            if model_id in self.host_models:
+                runner, nbytes = self.host_models[model_id]
+                if self.two_tiers and is_cpu_only(runner.model):
+                    self.host_models.move_to_end(model_id)
+                    return runner
+                del self.host_models[model_id]
+                runner.to(self.device)
+            else:
+                args, checkpoint = self.config(model_id), self.registry[model_id]['checkpoint']
+                runner = StreamingApply(args, checkpoint)
+                nbytes = model_nbytes(runner, checkpoint)
+                self.loads += 1
+                if self.two_tiers and is_cpu_only(runner.model):
+                    self.host_models[model_id] = (runner, nbytes)
+                    self._evict(keep_host=True)
+                    return runner
+            self.device_models[model_id] = (runner, nbytes)
+            self._evict()
+            return runner
+
+    def _evict(self, keep_host=False):
+        # every model but the most recently used one may go
+        while len(self.device_models) > 1 and self._over(self.device_models, self.device_budget):
+            model_id, (runner, nbytes) = self.device_models.popitem(last=False)
+            if self.two_tiers and is_movable(runner.model):
+                self.host_models[model_id] = (runner.to(torch.device('cpu')), nbytes)
+        # with keep_host the most recent host entry is the CPU-only model that was just requested
+        while len(self.host_models) > int(keep_host) and self._over(self.host_models, self.host_budget):
+            self.host_models.popitem(last=False)
+        if self.two_tiers:
+            torch.cuda.empty_cache()
+
+    @staticmethod
+    def _over(models, budget):
+        return budget is not None and sum(nbytes for _, nbytes in models.values()) > budget
+
+    def predict(self, model_id, images, sizes):
+        with self.lock:  # keeps the model on the device until the forward pass is done
+            return self.get(model_id).predict(images, sizes)
+
+    def check_shared(self, model_ids):
+        """Raises ValueError unless one batch prepared for model_ids[0] can go through every model:
+        letterboxed models need their own img_size there, squashed inputs are resized on the device."""
+        size = self.config(model_ids[0]).img_size
+        for model_id in model_ids[1:]:
+            args = self.config(model_id)
+            if args.aspect_buckets and args.img_size != size:
+                raise ValueError(f'{model_id} letterboxes to {args.img_size}, a shared batch is prepared '
+                                 f'for {model_ids[0]} at {size}')
+
+    def predict_shared(self, model_ids, images, sizes):
+        """Masks from several models for one batch, preprocessed for the first of them.
+
+        The batch goes to the device once; squashed (img_size x img_size) inputs are resized there for
+        models trained at another img_size. Letterboxed inputs cannot be, so those models must share
+        the first model's img_size. Returns {model_id: [uint8 mask per image]}.
+        """
+        self.check_shared(model_ids)
+        with self.lock:
+            images = images.to(self.device, dtype=torch.float32)
+            results = {}
+            for model_id in model_ids:
+                runner = self.get(model_id)
+                size = runner.args.img_size
+                inputs = images
+                if runner.letterbox is None and tuple(images.size()[-2:]) != (size, size):
+                    inputs = F.interpolate(images, size=(size, size), mode='bilinear', align_corners=False)
+                results[model_id] = runner.predict(inputs, sizes)
+            return results
+
+    def stats(self):
+        with self.lock:
+            return {'device': list(self.device_models), 'host': list(self.host_models), 'loads': self.loads,
+                    'device_mb': sum(n for _, n in self.device_models.values()) / 2 ** 20,
+                    'host_mb': sum(n for _, n in self.host_models.values()) / 2 ** 20}
+
+
+def get_pool(args, checkpoint=None):
+    """The pool described by --model_registry, or a single 'default' model from checkpoint."""
+    if args.model_registry is not None:
+        registry = read_registry(args.model_registry)
+    else:
+        registry = {'default': {'checkpoint': checkpoint}}
+    mb = lambda budget: None if budget is None else int(budget * 2 ** 20)
+    return ModelPool(args, registry, device_budget=mb(args.pool_device_mb), host_budget=mb(args.pool_host_mb))
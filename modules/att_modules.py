@@ -1,22 +1,19 @@
 """
 author: Min Seok Lee and Wooseok Shin
 """
-import numpy as np
+import math
+import torch
 import torch.nn as nn
 from torch.fft import fft2, fftshift, ifft2, ifftshift
-from util.utils import *
 import torch.nn.functional as F
-from config import getConfig
 from modules.conv_modules import BasicConv2d, DWConv, DWSConv
 
-cfg = getConfig()
-
 
 class Frequency_Edge_Module(nn.Module):
-    def __init__(self, radius, channel):
+    def __init__(self, radius, channel, confidence_ratio=0.1):
         super(Frequency_Edge_Module, self).__init__()
         self.radius = radius
-        self.UAM = UnionAttentionModule(channel, only_channel_tracing=True)
+        self.UAM = UnionAttentionModule(channel, only_channel_tracing=True, confidence_ratio=confidence_ratio)
 
         # DWS + DWConv
         self.DWSConv = DWSConv(channel, channel, kernel=3, padding=1, kernels_per_layer=1)
@@ -38,21 +35,65 @@ class Frequency_Edge_Module(nn.Module):
         )
         self.conv = BasicConv2d(channel, 1, 1)
 
-    def distance(self, i, j, imageSize, r):
-        dis = np.sqrt((i - imageSize / 2) ** 2 + (j - imageSize / 2) ** 2)
-        if dis < r:
-            return 1.0
-        else:
-            return 0
+        self._mask_cache = {}
+        self.register_buffer('high_pass_mask', None, persistent=False)
+        # Real DFT matrix products instead of torch.fft, for exporters without complex support (ONNX)
+        self.dft_matmul = False
 
     def mask_radial(self, img, r):
-        batch, channels, rows, cols = img.shape
-        mask = torch.zeros((rows, cols), dtype=torch.float32)
-        for i in range(rows):
-            for j in range(cols):
-                mask[i, j] = self.distance(i, j, imageSize=rows, r=r)
+        """Low-pass disc of radius r centred on the shifted spectrum, shaped like the last two dims of img."""
+        rows, cols = img.shape[-2:]
+        i = torch.arange(rows, device=img.device, dtype=torch.float64).unsqueeze(1) - rows / 2
+        j = torch.arange(cols, device=img.device, dtype=torch.float64).unsqueeze(0) - cols / 2
+        mask = (i * i + j * j) < r * r
+        return mask.to(img.dtype)
+
+    def high_pass(self, img):
+        """Returns the cached (1 - mask_radial) filter for img's spatial size, device and dtype.
+
+        The filter only depends on (H, W, radius, device, dtype), so it is built once per key and kept
+        out of the state dict. The dict is shared by nn.DataParallel replicas, so each GPU builds it once.
+        """
+        rows, cols = img.shape[-2:]
+        key = (rows, cols, self.radius, img.device, img.dtype)
+        mask = self._mask_cache.get(key)
+        if mask is None:
+            mask = 1 - self.mask_radial(img, r=self.radius)
+            self._mask_cache[key] = mask
+            self.high_pass_mask = mask
         return mask
 
+    def dft_matrices(self, img):
+        """Cached cos / sin DFT matrices for img's spatial size and the high-pass filter in the unshifted
+        spectrum: fftshift -> mask -> ifftshift equals masking with ifftshift(mask)."""
+        rows, cols = img.shape[-2:]
+        key = ('dft', rows, cols, self.radius, img.device, img.dtype)
+        mats = self._mask_cache.get(key)
+        if mats is None:
+            mats = []
+            for n in (rows, cols):
+                k = torch.arange(n, device=img.device, dtype=torch.float64)
+                angle = 2 * math.pi * torch.outer(k, k).remainder(n) / n
+                mats += [torch.cos(angle).to(img.dtype), torch.sin(angle).to(img.dtype)]
+            mats.append(ifftshift(self.high_pass(img)))
+            self._mask_cache[key] = mats
+        return mats
+
+    def high_pass_dft(self, x):
+        """|ifft2(ifftshift(fftshift(fft2(x)) * high_pass))| with the 2D DFT written as real matrix
+        products: X = F_H x F_W with F = C - iS, and the inverse with conj(F) / (H * W)."""
+        C_h, S_h, C_w, S_w, mask = self.dft_matrices(x)
+        # forward DFT of the real input
+        A_r, A_i = torch.matmul(C_h, x), -torch.matmul(S_h, x)
+        X_r = (torch.matmul(A_r, C_w) + torch.matmul(A_i, S_w)) * mask
+        X_i = (torch.matmul(A_i, C_w) - torch.matmul(A_r, S_w)) * mask
+        # inverse DFT
+        B_r = torch.matmul(C_h, X_r) - torch.matmul(S_h, X_i)
+        B_i = torch.matmul(C_h, X_i) + torch.matmul(S_h, X_r)
+        y_r = torch.matmul(B_r, C_w) - torch.matmul(B_i, S_w)
+        y_i = torch.matmul(B_r, S_w) + torch.matmul(B_i, C_w)
+        return torch.sqrt(y_r * y_r + y_i * y_i) / (x.size(-2) * x.size(-1))
+
     def forward(self, x):
         """
         Input:
@@ -60,15 +101,20 @@ class Frequency_Edge_Module(nn.Module):
         Returns:
             Edge refined representation: X + edge (B, C, H, W)
         """
-        x_fft = fft2(x, dim=(-2, -1))
-        x_fft = fftshift(x_fft)
+        # The FFT always runs in fp32: half precision cuFFT needs power-of-two sizes and loses the
+        # high frequencies this module is after. Autocast recasts x_H for the convolutions below.
+        x_fp32 = x.float()
+        if self.dft_matmul:
+            x_H = self.high_pass_dft(x_fp32)
+        else:
+            x_fft = fft2(x_fp32, dim=(-2, -1))
+            x_fft = fftshift(x_fft)
 
-        # Mask -> low, high separate
-        mask = self.mask_radial(img=x, r=self.radius).cuda()
-        high_frequency = x_fft * (1 - mask)
-        x_fft = ifftshift(high_frequency)
-        x_fft = ifft2(x_fft, dim=(-2, -1))
-        x_H = torch.abs(x_fft)
+            # Mask -> low, high separate
+            high_frequency = x_fft * self.high_pass(x_fp32)
+            x_fft = ifftshift(high_frequency)
+            x_fft = ifft2(x_fft, dim=(-2, -1))
+            x_H = torch.abs(x_fft)
 
         x_H, _ = self.UAM.Channel_Tracer(x_H)
         edge_maks = self.DWSConv(x_H)
@@ -137,10 +183,10 @@ class GlobalAvgPool(nn.Module):
 
 
 class UnionAttentionModule(nn.Module):
-    def __init__(self, n_channels, only_channel_tracing=False):
+    def __init__(self, n_channels, only_channel_tracing=False, confidence_ratio=0.1):
         super(UnionAttentionModule, self).__init__()
         self.GAP = GlobalAvgPool()
-        self.confidence_ratio = cfg.gamma
+        self.confidence_ratio = confidence_ratio
         self.bn = nn.BatchNorm2d(n_channels)
         self.norm = nn.Sequential(
             nn.BatchNorm2d(n_channels),
@@ -163,10 +209,14 @@ class UnionAttentionModule(nn.Module):
                                        padding=0, bias=False)
             self.spatial_v = nn.Conv2d(in_channels=n_channels, out_channels=1, kernel_size=1, stride=1,
                                        padding=0, bias=False)
+        else:
+            # self.bn is only used by forward(), which channel-only tracing never calls. Freezing it keeps
+            # the checkpoint keys while DDP does not wait for gradients that can never arrive.
+            self.bn.requires_grad_(False)
         self.sigmoid = nn.Sigmoid()
 
     def masking(self, x, mask):
-        mask = mask.squeeze(3).squeeze(2)
+        mask = mask.squeeze(3).squeeze(2).float()  # torch.quantile has no half precision kernel
         threshold = torch.quantile(mask, self.confidence_ratio, dim=-1, keepdim=True)
         mask[mask <= threshold] = 0.0
         mask = mask.unsqueeze(2).unsqueeze(3)
@@ -216,7 +266,7 @@ class UnionAttentionModule(nn.Module):
 
 
 class aggregation(nn.Module):
-    def __init__(self, channel):
+    def __init__(self, channel, confidence_ratio=0.1):
         super(aggregation, self).__init__()
         self.relu = nn.ReLU(True)
 
@@ -231,7 +281,7 @@ class aggregation(nn.Module):
         self.conv_concat3 = BasicConv2d((channel[0] + channel[1] + channel[2]),
                                         (channel[0] + channel[1] + channel[2]), 3, padding=1)
 
-        self.UAM = UnionAttentionModule(channel[0] + channel[1] + channel[2])
+        self.UAM = UnionAttentionModule(channel[0] + channel[1] + channel[2], confidence_ratio=confidence_ratio)
 
     def forward(self, e4, e3, e2):
         e4_1 = e4
@@ -251,9 +301,10 @@ class aggregation(nn.Module):
 
 
 class ObjectAttention(nn.Module):
-    def __init__(self, channel, kernel_size):
+    def __init__(self, channel, kernel_size, denoise=0.93):
         super(ObjectAttention, self).__init__()
         self.channel = channel
+        self.denoise = denoise
         self.DWSConv = DWSConv(channel, channel // 2, kernel=kernel_size, padding=1, kernels_per_layer=1)
         self.DWConv1 = nn.Sequential(
             DWConv(channel // 2, channel // 2, kernel=1, padding=0, dilation=1),
@@ -286,7 +337,7 @@ class ObjectAttention(nn.Module):
         x = mask_ob.expand(-1, self.channel, -1, -1).mul(encoder_map)
 
         edge = mask_bg.clone()
-        edge[edge > cfg.denoise] = 0
+        edge[edge > self.denoise] = 0
         x = x + (edge * encoder_map)
 
         x = self.DWSConv(x)
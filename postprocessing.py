@@ -1,22 +1,70 @@
+import threading
+from collections import OrderedDict
 import cv2
 import numpy as np
-from PIL import Image
+import torch
 
 
 class PostProcess():
-    def __init__(self):
-        self.bg = cv2.imread("./background/bg.jpg")
+    """Composites cutouts onto the background image.
 
+    Resized backgrounds are kept in a small LRU cache keyed by (w, h) (and device for tensors), so a
+    run over images of a handful of sizes resizes the background once per size. Blending is done with
+    integer arithmetic that reproduces PIL's Image.paste(fg, (0, 0), fg) bit for bit, either in NumPy
+    or, for tensors, on their device before the result is downloaded.
+    """
+    def __init__(self, bg_path="./background/bg.jpg", cache_size=16):
+        self.bg = cv2.imread(bg_path)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # postprocess is called from the apply writer threads
 
-    def postprocess(self, mask, w, h):
-        
-        bg = cv2.resize(self.bg, (w,h))
-        background = Image.fromarray(bg)
-        foreground = Image.fromarray(mask)
+    def background(self, w, h, device=None):
+        key = (w, h, None if device is None else str(device))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        bg = cv2.resize(self.bg, (w, h))
+        if device is not None:
+            bg = torch.from_numpy(bg).to(device)
+
+        with self._lock:
+            self._cache[key] = bg
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return bg
+
+    @staticmethod
+    def _blend(bg, fg, alpha):
+        # PIL's BLEND/DIV255: (bg * (255 - a) + fg * a) / 255 with round-half-up in integers
+        tmp = bg * (255 - alpha) + fg * alpha + 128
+        return ((tmp >> 8) + tmp) >> 8
 
-        background.paste(foreground, (0,0), foreground)
-        
-        # output_image = cv2.addWeighted(bg, 0.4, mask, 0.1, 0)
-        return np.asarray(background)
+    def composite(self, foreground, alpha, w, h):
+        """Alpha-blends foreground over the background resized to (w, h).
+
+        Args:
+            foreground: uint8 (h, w, 3) or (B, h, w, 3), a NumPy array or a tensor on any device.
+            alpha: uint8 (h, w) or (B, h, w) of the same type.
+        Returns:
+            uint8 composite shaped like foreground, NumPy in and NumPy out, tensor in and tensor out.
+        """
+        if torch.is_tensor(foreground):
+            bg = self.background(w, h, foreground.device).int()
+            out = self._blend(bg, foreground.int(), alpha.int().unsqueeze(-1))
+            return out.to(torch.uint8)
+
+        bg = self.background(w, h).astype(np.int32)
+        out = self._blend(bg, foreground.astype(np.int32), alpha.astype(np.int32)[..., None])
+        return out.astype(np.uint8)
+
+    def postprocess(self, mask, w, h):
+        """mask is a BGRA cutout (alpha in the last channel) or a single-channel map used as both."""
+        if mask.ndim == 2:
+            foreground, alpha = mask[..., None].repeat(3, axis=2), mask
+        else:
+            foreground, alpha = mask[..., :3], mask[..., 3]
 
-    
+        return self.composite(foreground, alpha, w, h)
@@ -0,0 +1,201 @@
+import os
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from tqdm import tqdm
+from custom_dataloader import get_test_augmentation, get_loader
+from model.EfficientNet import MBConvBlock
+from model.TRACER import TRACER
+from modules.att_modules import RFB_Block
+from modules.conv_modules import BasicConv2d, DWConv, DWSConv
+from util.effi_utils import Conv2dStaticSamePadding
+from util.metrics import Evaluation_metrics
+from util.utils import AvgMeter
+
+# Quantized as self-contained int8 units with fp32 inputs and outputs. The FFT high pass, the attention
+# modules and everything in between stay in fp32, so only the convolution stacks pay for the (de)quantization.
+QUANTIZED_UNITS = (MBConvBlock, RFB_Block, BasicConv2d, DWConv, DWSConv)
+
+
+class QuantizedUnit(nn.Module):
+    """Holds one FX-prepared / converted unit in place of the float module.
+
+    MBConvBlock is called with a drop_connect_rate, which only matters in training and is dropped here.
+    """
+    def __init__(self, module):
+        super(QuantizedUnit, self).__init__()
+        self.module = module
+
+    def forward(self, x, *args, **kwargs):
+        return self.module(x)
+
+
+class _Trace(nn.Module):
+    # single-input view of a unit, so FX traces its eval forward with the training-only arguments unset
+    def __init__(self, module):
+        super(_Trace, self).__init__()
+        self.module = module
+
+    def forward(self, x):
+        return self.module(x)
+
+
+def _plain_convs(module, prefix=''):
+    """Replaces the functional F.pad + F.conv2d of Conv2dStaticSamePadding with an nn.Conv2d module (and a
+    ZeroPad2d in front when the padding is asymmetric), so FX sees conv -> bn and fuses the pair.
+
+    Returns the names of the convs behind an asymmetric pad (the stride-2 depthwise convs). The int8
+    kernels have no fast path for their odd, pre-padded inputs and run several times slower than fp32,
+    so they are kept in fp32.
+    """
+    padded = []
+    for name, child in module.named_children():
+        if not isinstance(child, Conv2dStaticSamePadding):
+            padded += _plain_convs(child, f'{prefix}{name}.')
+            continue
+        conv = nn.Conv2d(child.in_channels, child.out_channels, child.kernel_size, child.stride,
+                         dilation=child.dilation, groups=child.groups, bias=child.bias is not None)
+        conv.weight, conv.bias = child.weight, child.bias
+        conv.train(child.training)
+        pad = child.static_padding
+        if isinstance(pad, nn.ZeroPad2d) and pad.padding[0] == pad.padding[1] and pad.padding[2] == pad.padding[3]:
+            conv.padding = (pad.padding[2], pad.padding[0])
+            pad = nn.Identity()
+        if isinstance(pad, nn.Identity):
+            setattr(module, name, conv)
+        else:
+            setattr(module, name, nn.Sequential(pad, conv))
+            padded.append(f'{prefix}{name}.1')
+    return padded
+
+
+def _units(module):
+    """(parent, name, unit) for every outermost QUANTIZED_UNITS instance below module."""
+    for name, child in module.named_children():
+        if isinstance(child, QUANTIZED_UNITS):
+            yield module, name, child
+        else:
+            yield from _units(child)
+
+
+def prepare_quantization(model, example_images, engine):
+    """Swaps every unit of the eval-mode TRACER for an observed FX graph; conv + BN pairs are fused.
+
+    Ops without an int8 kernel inside a unit (SELU) are left in fp32 by FX. example_images only
+    provides each unit's input shape, which is recorded with one forward pass.
+    """
+    torch.backends.quantized.engine = engine
+    model.eval()
+    model.model.set_swish(memory_efficient=False)  # the autograd.Function swish cannot be traced
+
+    units = list(_units(model))
+    inputs = {}
+    hooks = [unit.register_forward_pre_hook(lambda m, args: inputs.setdefault(id(m), args[0]))
+             for _, _, unit in units]
+    with torch.no_grad():
+        model(example_images[:1])
+    for hook in hooks:
+        hook.remove()
+
+    for parent, name, unit in units:
+        qconfig_mapping = get_default_qconfig_mapping(engine)
+        for conv_name in _plain_convs(unit, prefix='module.'):
+            qconfig_mapping.set_module_name(conv_name, None)
+        prepared = prepare_fx(_Trace(unit), qconfig_mapping, example_inputs=(inputs[id(unit)],))
+        setattr(parent, name, QuantizedUnit(prepared))
+    return model
+
+
+def convert_quantization(model):
+    for module in model.modules():
+        if isinstance(module, QuantizedUnit):
+            module.module = convert_fx(module.module)
+    return model
+
+
+def is_quantized(checkpoint):
+    return isinstance(checkpoint, dict) and 'quantization' in checkpoint
+
+
+def load_quantized(args, checkpoint):
+    """Rebuilds the int8 graph structure on a fresh TRACER and loads the saved weights and scales."""
+    model = TRACER(args, pretrained=False)
+    example = torch.rand(1, 3, args.img_size, args.img_size)
+    model = convert_quantization(prepare_quantization(model, example, checkpoint['quantization']))
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.eval()
+
+
+def quantize_model(model, calib_loader, num_batches, engine):
+    """Static post-training quantization: prepare, calibrate the observers on num_batches, convert."""
+    images = next(iter(calib_loader))[0].float()
+    model = prepare_quantization(model, images, engine)
+    with torch.no_grad():
+        for i, batch in enumerate(tqdm(calib_loader, total=min(num_batches, len(calib_loader)))):
+            if i == num_batches:
+                break
+            model(batch[0].float())
+    return convert_quantization(model)
+
+
+def compare_models(args, models, test_loader):
+    """MAE / max-F / S-measure and forward latency per model on the test set, via Evaluation_metrics."""
+    Eval_tool = Evaluation_metrics(args.dataset, torch.device('cpu'))
+    results = {}
+    for label, model in models.items():
+        mae, maxf, s_m = AvgMeter(), AvgMeter(), AvgMeter()
+        latency = 0.0
+        count = 0
+        with torch.no_grad():
+            model(next(iter(test_loader))[0].float())  # warm-up: weight prepacking and allocator
+            for images, masks, original_size, image_name in tqdm(test_loader):
+                t = time.time()
+                outputs, edge_mask, ds_map = model(images.float())
+                latency += time.time() - t
+                count += images.size(0)
+
+                H, W = original_size
+                outputs = F.interpolate(outputs.float(), size=(H[0].item(), W[0].item()), mode='bilinear')
+                batch_mae, batch_maxf, _, batch_s = Eval_tool.cal_batch_metrics(outputs, masks.float())
+                n = images.size(0)
+                mae.update(batch_mae.mean().item(), n=n)
+                maxf.update(batch_maxf.mean().item(), n=n)
+                s_m.update(batch_s.mean().item(), n=n)
+
+        results[label] = (mae.avg, maxf.avg, s_m.avg, 1000 * latency / max(count, 1))
+        print(f'{label:>5} | MAE:{mae.avg:.4f} | MAX_F:{maxf.avg:.4f} | S_Measure:{s_m.avg:.4f} '
+              f'| latency: {results[label][3]:.1f} ms/img')
+    return results
+
+
+def run_quantization(args, checkpoint, output_file):
+    """quantize action: int8 PTQ of a trained checkpoint, calibrated on the validation split of
+    Train/, saved as {'quantization': engine, 'state_dict': ...} and compared with fp32 on Test/."""
+    from inference import load_model  # inference imports this module to load int8 checkpoints
+
+    engine = args.quant_engine
+    transform = get_test_augmentation(img_size=args.img_size)
+    tr_folder = os.path.join(args.data_path, args.dataset, 'Train')
+    calib_loader = get_loader(os.path.join(tr_folder, 'images/'), os.path.join(tr_folder, 'masks/'),
+                              os.path.join(tr_folder, 'edges/'), phase='val', batch_size=args.batch_size,
+                              shuffle=False, num_workers=args.num_workers, transform=transform, seed=args.seed)
+
+    fp32_model = load_model(args, checkpoint, torch.device('cpu'))
+    int8_model = quantize_model(load_model(args, checkpoint, torch.device('cpu')), calib_loader,
+                                args.calib_batches, engine)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    torch.save({'quantization': engine, 'state_dict': int8_model.state_dict()}, output_file)
+    print(f'Saved int8 model to {output_file}')
+
+    te_img_folder = os.path.join(args.data_path, args.dataset, 'Test/images/')
+    te_gt_folder = os.path.join(args.data_path, args.dataset, 'Test/masks/')
+    if os.path.isdir(te_gt_folder):
+        test_loader = get_loader(te_img_folder, te_gt_folder, edge_folder=None, phase='test',
+                                 batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers,
+                                 transform=transform)
+        compare_models(args, {'fp32': fp32_model, 'int8': int8_model}, test_loader)
+    return output_file
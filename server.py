@@ -0,0 +1,276 @@
+import json
+import time
+import base64
+import queue
+import threading
+import traceback
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import cv2
+import numpy as np
+import torch
+from custom_dataloader import prepare_image
+from inference import StreamingApply, collect_inputs, input_transform
+from model_pool import UnknownModel, get_pool
+from postprocessing import PostProcess
+
+OUTPUTS = ('mask', 'cutout')
+
+
+class MicroBatcher():
+    """Coalesces concurrent requests into batches for one worker thread.
+
+    The worker takes the first queued item, then keeps collecting until it holds max_batch items or
+    max_latency seconds have passed since the first one, and hands the whole list to process(items),
+    which returns one result per item. submit() returns a Future resolved with the item's result.
+    A result that is an exception instance fails only that item's future; an exception raised by
+    process() fails the whole batch.
+    """
+    def __init__(self, process, max_batch, max_latency):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self.thread = threading.Thread(target=self._loop, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is None:
+                self.queue.put(None)  # finish this batch, stop on the next _collect
+                break
+            batch.append(entry)
+        return batch
+
+    def _loop(self):
+        with torch.no_grad():  # grad mode is per thread
+            while True:
+                batch = self._collect()
+                if batch is None:
+                    return
+                items, futures = zip(*batch)
+                try:
+                    results = self.process(list(items))
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.items += len(items)
+                for future, result in zip(futures, results):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+
+class TracerService():
+    """Serves masks / cutouts from a ModelPool: one checkpoint (anything load_model accepts), or every
+    model of --model_registry, addressed by id.
+
+    Request threads decode and preprocess the image and encode the PNG answer; only the forward pass
+    goes through the MicroBatcher, which runs batches of up to args.batch_size images, waiting at
+    most args.max_latency_ms for a batch to fill. Requests for several models at once are
+    preprocessed once and share their batch on the device (ModelPool.predict_shared).
+    """
+    def __init__(self, args, checkpoint):
+        self.pool = get_pool(args, checkpoint)
+        self.inputs = {model_id: input_transform(self.pool.config(model_id)) for model_id in self.pool.model_ids}
+        self.post_process = PostProcess()
+        self.batcher = MicroBatcher(self._forward, max_batch=args.batch_size,
+                                    max_latency=args.max_latency_ms / 1000)
+
+    def _forward(self, items):
+        # requests for the same model(s) with equal input shapes (letterboxing varies them) are stacked
+        groups = {}
+        for i, (model_ids, image, size) in enumerate(items):
+            groups.setdefault((model_ids, tuple(image.shape)), []).append(i)
+        results = [None] * len(items)
+        for (model_ids, _), indices in groups.items():
+            try:
+                images = torch.stack([items[i][1] for i in indices])
+                masks = self.pool.predict_shared(model_ids, images, [items[i][2] for i in indices])
+            except Exception as e:
+                # e.g. one model running out of memory: fail this group's requests, not the whole batch
+                for i in indices:
+                    results[i] = e
+                continue
+            for j, i in enumerate(indices):
+                results[i] = {model_id: masks[model_id][j] for model_id in model_ids}
+        return results
+
+    def cutout(self, orig_image, mask):
+        # as StreamingApply.cutout, without touching the pool's LRU order from a request thread
+        h, w = orig_image.shape[:2]
+        return self.post_process.postprocess(StreamingApply.apply_mask(orig_image, mask), w, h)
+
+    def __call__(self, data, output='mask', model_ids=None):
+        """{model_id: PNG bytes of the mask or the composited cutout} for an encoded image."""
+        model_ids = tuple(model_ids or self.pool.model_ids[:1])
+        unknown = [model_id for model_id in model_ids if model_id not in self.inputs]
+        if unknown:
+            raise UnknownModel(f'Unknown model id(s) {unknown}, expected {self.pool.model_ids}')
+        self.pool.check_shared(model_ids)  # reject an incompatible combination before it joins a batch
+        orig_image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if orig_image is None:
+            raise ValueError('Could not decode the image')
+        image = prepare_image(orig_image, *self.inputs[model_ids[0]])
+        masks = self.batcher.submit((model_ids, image, orig_image.shape[:2])).result()
+
+        results = {}
+        for model_id, mask in masks.items():
+            result = mask if output == 'mask' else self.cutout(orig_image, mask)
+            ok, encoded = cv2.imencode('.png', result)
+            if not ok:
+                raise IOError('Could not encode the result')
+            results[model_id] = encoded.tobytes()
+        return results
+
+    def stats(self):
+        batches = self.batcher.batches
+        return {'batches': batches, 'images': self.batcher.items,
+                'mean_batch_size': self.batcher.items / batches if batches else 0.0,
+                'models': self.pool.stats()}
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        """POST /predict[?output=mask|cutout][&model=id[,id...]] with the encoded image as body -> image/png,
+        or JSON {model_id: base64 PNG} for several models. GET /health -> JSON batching / pool statistics.
+        Errors are JSON {'error': message}: 400 for bad input, 404 for unknown paths / model ids, 500 otherwise."""
+        def _reply(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, code, message):
+            self._reply(code, json.dumps({'error': message}).encode(), 'application/json')
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/health':
+                return self._error(404, 'not found')
+            self._reply(200, json.dumps(service.stats()).encode(), 'application/json')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                return self._error(404, 'not found')
+            query = parse_qs(url.query)
+            output = query.get('output', ['mask'])[0]
+            if output not in OUTPUTS:
+                return self._error(400, f'output must be one of {OUTPUTS}')
+            model_ids = query['model'][0].split(',') if 'model' in query else None
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                return self._error(400, 'Content-Length must be a non-negative integer')
+            data = self.rfile.read(length)
+            try:
+                results = service(data, output, model_ids)
+            except UnknownModel as e:
+                return self._error(404, e.args[0])
+            except ValueError as e:
+                return self._error(400, str(e))
+            except Exception as e:
+                # decoding, the forward pass or the batcher failed: answer instead of dropping the connection
+                traceback.print_exc()
+                return self._error(500, f'{type(e).__name__}: {e}')
+            if len(results) == 1:
+                return self._reply(200, next(iter(results.values())), 'image/png')
+            body = {model_id: base64.b64encode(png).decode() for model_id, png in results.items()}
+            self._reply(200, json.dumps(body).encode(), 'application/json')
+
+        def log_message(self, format, *args):
+            pass  # one line per request would dominate the output under load
+
+    return Handler
+
+
+def serve(args, checkpoint):
+    service = TracerService(args, checkpoint)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    print(f'Serving {", ".join(service.pool.model_ids)} on http://{args.host}:{args.port} '
+          f'(max batch {args.batch_size}, max latency {args.max_latency_ms} ms)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.batcher.close()
+
+
+def run_load(url, paths, num_requests, concurrency, output='mask', models=None):
+    """Load generator: num_requests POSTs of the given images from concurrency client threads.
+
+    A first round of concurrency requests warms the server up and is not counted.
+    Returns and prints the p50 / p99 request latency in ms and the images per second.
+    """
+    payloads = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            payloads.append(f.read())
+    endpoint = f'{url.rstrip("/")}/predict?output={output}'
+    models = models or [None]  # None: the server's default model
+
+    def request(i):
+        t = time.perf_counter()
+        model = models[i % len(models)]
+        req = urllib.request.Request(endpoint + (f'&model={model}' if model else ''),
+                                     data=payloads[i % len(payloads)], method='POST',
+                                     headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(req) as response:
+            response.read()
+        return time.perf_counter() - t
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(request, range(concurrency)))
+        t = time.perf_counter()
+        latencies = np.array(list(pool.map(request, range(num_requests)))) * 1000
+        elapsed = time.perf_counter() - t
+
+    results = {'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+               'images_per_s': num_requests / elapsed}
+    print(f'{num_requests} requests, concurrency {concurrency}: p50 {results["p50_ms"]:.1f} ms '
+          f'| p99 {results["p99_ms"]:.1f} ms | {results["images_per_s"]:.2f} img/s')
+    with urllib.request.urlopen(f'{url.rstrip("/")}/health') as response:
+        print(f'server: {json.loads(response.read())}')
+    return results
+
+
+def load_test(args):
+    paths = collect_inputs(args.input)
+    if not paths:
+        raise FileNotFoundError(f'No images found for {args.input}')
+    return run_load(args.url or f'http://{args.host}:{args.port}', paths, args.num_requests, args.concurrency,
+                    output=args.serve_output, models=args.models)
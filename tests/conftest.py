@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+import cv2
+import numpy as np
+import pytest
+import torch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from config import default_config  # noqa: E402
+from model.TRACER import TRACER  # noqa: E402
+
+IMG_SIZE = 64
+
+
+def write_split(folder, sizes, edges=False, seed=0):
+    rng = np.random.default_rng(seed)
+    for sub in ('images', 'masks') + (('edges',) if edges else ()):
+        os.makedirs(os.path.join(folder, sub), exist_ok=True)
+    for i, (h, w) in enumerate(sizes):
+        image = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        mask = np.zeros((h, w), np.uint8)
+        mask[h // 4:3 * h // 4, w // 5:4 * w // 5] = 255
+        cv2.imwrite(os.path.join(folder, 'images', f'{i}.png'), image)
+        cv2.imwrite(os.path.join(folder, 'masks', f'{i}.png'), mask)
+        if edges:
+            cv2.imwrite(os.path.join(folder, 'edges', f'{i}.png'), cv2.Canny(mask, 100, 200))
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    """<tmp>/data/car_data with a Train split (with edges) and a Test split of mixed image sizes;
+    car_data is the dataset name the test action evaluates."""
+    root = tmp_path / 'data'
+    write_split(str(root / 'car_data' / 'Train'), [(48, 40)] * 6, edges=True)
+    write_split(str(root / 'car_data' / 'Test'), [(48, 40), (48, 40), (30, 50)], seed=1)
+    return str(root)
+
+
+def tiny_config(**overrides):
+    return default_config(arch='0', img_size=IMG_SIZE, **overrides)
+
+
+def build_model():
+    torch.manual_seed(0)
+    return TRACER(tiny_config(), pretrained=False).eval()
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    """Randomly initialized b0 weights saved from nn.DataParallel, i.e. with the 'module.' prefix."""
+    path = str(tmp_path / 'weights.pth')
+    torch.save(torch.nn.DataParallel(build_model()).state_dict(), path)
+    return path
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    """Working directory for main.py with the ./background/bg.jpg that PostProcess composites onto."""
+    os.makedirs(tmp_path / 'background')
+    cv2.imwrite(str(tmp_path / 'background' / 'bg.jpg'), np.full((60, 80, 3), 127, np.uint8))
+    return tmp_path
+
+
+def run_main(*args, cwd):
+    """Runs main.py in a subprocess in cwd, as from the command line, and returns its stdout."""
+    env = dict(os.environ, MPLBACKEND='Agg', TRACER_OFFLINE='1')
+    result = subprocess.run([sys.executable, os.path.join(REPO_ROOT, 'main.py'), *map(str, args)],
+                            cwd=cwd, env=env, capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-4000:]
+    return result.stdout
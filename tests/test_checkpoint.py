@@ -0,0 +1,42 @@
+import os
+import torch
+from util.checkpoint import CheckpointManager, latest_checkpoint, read_index, resume
+
+
+def save_run(save_path, losses, resume=False, keep_last=1, keep_best=1):
+    model = torch.nn.Linear(2, 1)
+    optimizer = torch.optim.Adam(model.parameters())
+    manager = CheckpointManager(save_path, keep_last=keep_last, keep_best=keep_best, resume=resume)
+    for epoch, loss in losses.items():
+        manager.save(epoch, loss, model, optimizer, is_best=loss == min(losses.values()))
+    manager.close()
+
+
+def test_rotation(tmp_path):
+    save_run(str(tmp_path), {1: 0.5, 2: 0.1, 3: 0.4, 4: 0.3})
+    assert read_index(str(tmp_path)) == {2: 0.1, 4: 0.3}
+    assert sorted(os.listdir(tmp_path)) == ['2_checkpoint.pth', '4_checkpoint.pth', 'best_model.pth',
+                                            'checkpoints.json']
+    assert latest_checkpoint(str(tmp_path)) == os.path.join(str(tmp_path), '4_checkpoint.pth')
+
+
+def test_fresh_run_ignores_the_previous_index(tmp_path):
+    save_run(str(tmp_path), {1: 0.01, 2: 0.02})  # a previous run with much lower losses
+    save_run(str(tmp_path), {1: 0.5, 2: 0.4, 3: 0.6})
+    # ranked against the old 0.01 / 0.02, the new run's best epoch 2 would have been deleted
+    assert read_index(str(tmp_path)) == {2: 0.4, 3: 0.6}
+    assert os.path.isfile(tmp_path / '2_checkpoint.pth') and os.path.isfile(tmp_path / '3_checkpoint.pth')
+
+
+def test_resumed_run_keeps_the_index(tmp_path):
+    save_run(str(tmp_path), {1: 0.2, 2: 0.5})
+    save_run(str(tmp_path), {3: 0.4}, resume=True)
+    assert read_index(str(tmp_path)) == {1: 0.2, 3: 0.4}
+
+
+def test_checkpoints_load_without_the_unpickler(tmp_path):
+    save_run(str(tmp_path), {1: 0.3})
+    checkpoint = torch.load(tmp_path / '1_checkpoint.pth', weights_only=True)  # no arbitrary pickled code
+    model = torch.nn.Linear(2, 1)
+    resume(str(tmp_path / '1_checkpoint.pth'), model, torch.optim.Adam(model.parameters()))
+    assert torch.equal(model.weight, checkpoint['model']['weight'])
@@ -0,0 +1,28 @@
+import os
+import pytest
+from conftest import IMG_SIZE, run_main
+
+COMMON = ('--arch', '0', '--img_size', IMG_SIZE, '--batch_size', 2, '--num_workers', 0)
+
+
+def run_test_action(data_path, checkpoint, workdir, fmt='pth'):
+    if fmt == 'safetensors':
+        path = str(workdir / 'weights.safetensors')
+        run_main('export', *COMMON, '--checkpoint', checkpoint, '--export_format', 'safetensors',
+                 '--export_path', path, cwd=workdir)
+    elif fmt == 'int8':
+        path = str(workdir / 'weights-int8.pth')
+        run_main('quantize', *COMMON, '--data_path', data_path, '--dataset', 'car_data', '--checkpoint', checkpoint,
+                 '--export_path', path, '--calib_batches', 1, cwd=workdir)
+    else:
+        path = checkpoint
+    return run_main('test', *COMMON, '--data_path', data_path, '--checkpoint', path, '--save_map', 'True',
+                    '--output_path', workdir / 'maps', cwd=workdir)
+
+
+@pytest.mark.parametrize('fmt', ['pth', 'safetensors', 'int8'])
+def test_test_action(data_path, checkpoint, workdir, fmt):
+    stdout = run_test_action(data_path, checkpoint, workdir, fmt)
+    assert 'Test Loss:' in stdout
+    model_name = {'pth': 'weights', 'safetensors': 'weights', 'int8': 'weights-int8'}[fmt]
+    assert sorted(os.listdir(workdir / 'maps' / model_name)) == ['0.png', '1.png', '2.png']
@@ -0,0 +1,51 @@
+import importlib.util
+import torch
+from conftest import IMG_SIZE, build_model, tiny_config
+from export import export_onnx, export_torchscript
+from model_pool import ModelPool
+from quantization import quantize_model
+
+
+def write_int8(path):
+    calib = [(torch.rand(2, 3, IMG_SIZE, IMG_SIZE),)]
+    int8_model = quantize_model(build_model(), calib, num_batches=1, engine='x86')
+    torch.save({'quantization': 'x86', 'state_dict': int8_model.state_dict()}, path)
+
+
+def test_eviction_with_cpu_only_models(checkpoint, tmp_path):
+    args = tiny_config(action='serve', batch_size=1)
+    registry = {'fp32': {'checkpoint': checkpoint}, 'fp32_copy': {'checkpoint': checkpoint},
+                'script': {'checkpoint': export_torchscript(args, checkpoint, str(tmp_path / 'model.torchscript.pt'))},
+                'int8': {'checkpoint': str(tmp_path / 'int8.pth')}}
+    write_int8(registry['int8']['checkpoint'])
+    if importlib.util.find_spec('onnxruntime') is not None:
+        registry['onnx'] = {'checkpoint': export_onnx(args, checkpoint, str(tmp_path / 'model.onnx'))}
+
+    pool = ModelPool(args, registry)
+    fp32_bytes = sum(t.numel() * t.element_size() for t in build_model().state_dict().values())
+    # a device tier that holds one fp32 model, simulated on the CPU
+    pool.two_tiers, pool.device_budget = True, int(1.5 * fp32_bytes)
+    images, sizes = torch.rand(1, 3, IMG_SIZE, IMG_SIZE), [(40, 30)]
+
+    cpu_only = [model_id for model_id in ('int8', 'onnx') if model_id in registry]
+    for model_id in cpu_only:
+        assert pool.predict(model_id, images, sizes)[0].shape == (40, 30)
+    pool.predict('fp32', images, sizes)
+    pool.predict('script', images, sizes)
+    pool.predict('fp32_copy', images, sizes)
+
+    stats = pool.stats()
+    # CPU-only models stay in the host tier, outside the device budget; the evicted fp32 model moved to
+    # the host tier, the TorchScript graph (frozen for its device) was dropped
+    assert stats['device'] == ['fp32_copy']
+    assert stats['host'] == cpu_only + ['fp32']
+    assert stats['device_mb'] * 2 ** 20 <= pool.device_budget
+
+    loads = pool.loads
+    for model_id in cpu_only:
+        pool.predict(model_id, images, sizes)
+    assert pool.stats()['device'] == ['fp32_copy'] and pool.loads == loads
+    pool.predict('fp32', images, sizes)  # promoted back, not reloaded
+    assert pool.loads == loads
+    pool.predict('script', images, sizes)  # reloaded
+    assert pool.loads == loads + 1
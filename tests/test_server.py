@@ -0,0 +1,109 @@
+import http.client
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+import cv2
+import numpy as np
+import pytest
+from conftest import tiny_config
+from server import MicroBatcher, TracerService, make_handler
+
+
+@pytest.fixture
+def service(checkpoint, tmp_path):
+    registry = {'a': {'checkpoint': checkpoint}, 'b': {'checkpoint': checkpoint},
+                'wide': {'checkpoint': checkpoint, 'aspect_buckets': True, 'img_size': 96}}
+    with open(tmp_path / 'models.json', 'w') as f:
+        json.dump(registry, f)
+    args = tiny_config(action='serve', batch_size=4, max_latency_ms=200, model_registry=str(tmp_path / 'models.json'))
+    service = TracerService(args, None)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(service))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    service.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield service
+    server.shutdown()
+    server.server_close()
+    service.batcher.close()
+
+
+def image_bytes():
+    ok, image = cv2.imencode('.png', np.zeros((40, 30, 3), np.uint8))
+    return image.tobytes()
+
+
+def post(url, data, query=''):
+    request = urllib.request.Request(f'{url}/predict{query}', data=data, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_predict(service):
+    status, body = post(service.url, image_bytes())
+    assert status == 200
+    assert cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_UNCHANGED).shape == (40, 30)
+
+
+def test_model_error_is_a_500(service):
+    def fail(model_ids, images, sizes):
+        raise RuntimeError('out of memory')
+    service.pool.predict_shared = fail
+    assert post(service.url, image_bytes()) == (500, {'error': 'RuntimeError: out of memory'})
+
+    # the batcher keeps serving after a failed batch
+    del service.pool.predict_shared
+    assert post(service.url, image_bytes())[0] == 200
+
+
+def test_failure_stays_in_its_group(service):
+    predict_shared = service.pool.predict_shared
+
+    def fail_b(model_ids, images, sizes):
+        if 'b' in model_ids:
+            raise RuntimeError('out of memory')
+        return predict_shared(model_ids, images, sizes)
+    service.pool.predict_shared = fail_b
+
+    # both requests land in one micro-batch (max_latency_ms=200), only b's group fails
+    with ThreadPoolExecutor(2) as pool:
+        a = pool.submit(post, service.url, image_bytes(), '?model=a')
+        time.sleep(0.02)
+        b = pool.submit(post, service.url, image_bytes(), '?model=b')
+        assert a.result()[0] == 200
+        assert b.result() == (500, {'error': 'RuntimeError: out of memory'})
+    assert service.batcher.batches == 1
+
+
+def test_bad_requests(service):
+    assert post(service.url, image_bytes(), '?model=nope')[0] == 404
+    # a letterboxed 96px model cannot share a batch prepared for a 64px one: rejected before batching
+    status, body = post(service.url, image_bytes(), '?model=a,wide')
+    assert status == 400 and 'letterboxes' in body['error']
+    assert service.batcher.items == 0
+
+    host, port = service.url[len('http://'):].split(':')
+    connection = http.client.HTTPConnection(host, int(port), timeout=60)
+    connection.putrequest('POST', '/predict')
+    connection.putheader('Content-Length', 'abc')
+    connection.endheaders()
+    response = connection.getresponse()
+    assert response.status == 400
+    connection.close()
+
+
+def test_micro_batcher_fails_items_individually():
+    batcher = MicroBatcher(lambda items: [ValueError(item) if item < 0 else 2 * item for item in items],
+                           max_batch=4, max_latency=0.1)
+    futures = [batcher.submit(item) for item in (1, -1, 3)]
+    assert futures[0].result() == 2 and futures[2].result() == 6
+    with pytest.raises(ValueError):
+        futures[1].result()
+    batcher.close()
@@ -0,0 +1,61 @@
+import torch
+import torch.nn.functional as F
+
+
+def tile_origins(length, tile, stride):
+    """Start offsets of tiles of size tile covering [0, length); the last tile is flush with the end."""
+    if length <= tile:
+        return [0]
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+
+def feather_window(tile, overlap, device=None):
+    """(tile, tile) blending weights that ramp linearly over the overlap at every edge.
+
+    The weights stay strictly positive, so pixels on the image border, which only one tile covers,
+    are still normalized back to that tile's prediction.
+    """
+    ramp = torch.clamp((torch.arange(tile, dtype=torch.float32) + 1) / (overlap + 1), max=1.0)
+    ramp = torch.minimum(ramp, ramp.flip(0))
+    return (ramp[:, None] * ramp[None, :]).to(device)
+
+
+def forward_mask(model, images, amp=False, memory_format=torch.contiguous_format):
+    with torch.cuda.amp.autocast(enabled=amp):
+        outputs, edge_mask, ds_map = model(images.contiguous(memory_format=memory_format))
+    return outputs.float()
+
+
+def tiled_predict(model, image, tile, stride, batch_size, global_size=None, global_weight=0.5,
+                  amp=False, memory_format=torch.contiguous_format):
+    """Saliency mask of one normalized (1, 3, H, W) image at its native resolution.
+
+    Overlapping (tile x tile) crops every stride pixels go through the model batch_size at a time
+    and are blended with feather_window weights, so memory is bounded by the tile size instead of
+    H x W. Images smaller than a tile are edge-padded up to it. With global_weight > 0 the whole
+    image is also predicted once at (global_size x global_size), upsampled and mixed in, which gives
+    the tiles the object-level context that a single crop lacks.
+    Returns the (1, 1, H, W) float mask.
+    """
+    _, _, H, W = image.size()
+    padded = F.pad(image, (0, max(tile - W, 0), 0, max(tile - H, 0)), mode='replicate')
+    PH, PW = padded.size()[-2:]
+
+    window = feather_window(tile, tile - stride, device=image.device)
+    mask = image.new_zeros(1, 1, PH, PW)
+    weight = image.new_zeros(1, 1, PH, PW)
+    origins = [(y, x) for y in tile_origins(PH, tile, stride) for x in tile_origins(PW, tile, stride)]
+    for i in range(0, len(origins), batch_size):
+        batch = origins[i:i + batch_size]
+        tiles = torch.cat([padded[:, :, y:y + tile, x:x + tile] for y, x in batch])
+        outputs = forward_mask(model, tiles, amp, memory_format)
+        for (y, x), output in zip(batch, outputs):
+            mask[:, :, y:y + tile, x:x + tile] += output * window
+            weight[:, :, y:y + tile, x:x + tile] += window
+    mask = (mask / weight)[:, :, :H, :W]
+
+    if global_weight > 0:
+        context = F.interpolate(image, size=(global_size, global_size), mode='bilinear', align_corners=False)
+        context = F.interpolate(forward_mask(model, context, amp, memory_format), size=(H, W), mode='bilinear')
+        mask = (1 - global_weight) * mask + global_weight * context
+    return mask
@@ -5,6 +5,7 @@ from asyncore import write
 from csv import writer
 import glob
 import ntpath
+from contextlib import nullcontext
 import os
 import cv2
 import time
@@ -13,12 +14,18 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from tqdm import tqdm
-from custom_dataloader import get_train_augmentation, get_test_augmentation, get_loader, gt_to_tensor
+from custom_dataloader import get_train_augmentation, get_test_augmentation, get_normalize_augmentation, get_loader, \
+    letterbox_size
 from util.utils import AvgMeter, save_plot
 from util.metrics import Evaluation_metrics
-from util.losses import Optimizer, Scheduler, Criterion
+from util.losses import Optimizer, Scheduler, Criterion, MultiCriterion
+from util.distributed import init_distributed, is_distributed, is_main_process, barrier, wrap_model, local_model
+from util.checkpoint import CheckpointManager, latest_checkpoint, load_checkpoint, resume, unwrap
+from util.output_sink import get_sink
+from util.performance import memory_format
 from model.TRACER import TRACER
 from postprocessing import PostProcess
+from inference import load_model, is_cpu_only
 from torch.utils.tensorboard import SummaryWriter
 import matplotlib.pyplot as plt 
 from util.utils import save_plot
@@ -28,7 +35,8 @@ from util.utils import save_plot
 class Trainer():
     def __init__(self, args, save_path):
         super(Trainer, self).__init__()
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = init_distributed(args)
+        self.distributed = is_distributed()
         self.size = args.img_size
 
         self.tr_img_folder = os.path.join(args.data_path, args.dataset, 'Train/images/')
@@ -40,12 +48,15 @@ class Trainer():
 
         self.train_loader = get_loader(self.tr_img_folder, self.tr_gt_folder, self.tr_edge_folder, phase='train',
                                        batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
-                                       transform=self.train_transform, seed=args.seed)
+                                       transform=self.train_transform, seed=args.seed,
+                                       packed_path=args.packed_data, distributed=self.distributed)
         self.val_loader = get_loader(self.tr_img_folder, self.tr_gt_folder, self.tr_edge_folder, phase='val',
                                      batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers,
-                                     transform=self.test_transform, seed=args.seed)
+                                     transform=self.test_transform, seed=args.seed,
+                                     packed_path=args.packed_data, distributed=self.distributed)
 
-        self.writer = SummaryWriter()
+        # Only rank 0 logs, plots and writes checkpoints
+        self.writer = SummaryWriter() if is_main_process() else None
         self.args = args # added for val
         self.post_process = PostProcess() # added for val
         self.te_img_name_to_te_img_file = {
@@ -54,21 +65,28 @@ class Trainer():
         
 
         # Network
-        self.model = self.model = TRACER(args).to(self.device)
-        if args.multi_gpu:
-            self.model = nn.DataParallel(self.model).to(self.device)
+        # channels_last under --profile fast, NCHW otherwise
+        self.memory_format = memory_format(args.profile)
+        self.model = self.model = TRACER(args).to(self.device, memory_format=self.memory_format)
+        self.model = wrap_model(self.model, args, self.device)
 
         
-        self.model.load_state_dict(torch.load('/content/TRACER/results/22_model_weights.pth'))
+        unwrap(self.model).load_state_dict(load_checkpoint('/content/TRACER/results/22_model_weights.pth', self.device))
 
         # Loss and Optimizer
         self.criterion = Criterion(args)
+        self.multi_criterion = MultiCriterion(args)
         self.optimizer = Optimizer(args, self.model)
         self.scheduler = Scheduler(args, self.optimizer)
 
+        # Mixed precision: autocast on the forward pass, losses and metrics stay in fp32
+        self.amp = bool(args.amp) and self.device.type == 'cuda'
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp)
+
         # Train / Validate
         min_loss = 1000
         early_stopping = 0
+        best_epoch, best_mae = 0, float('nan')
         t = time.time()
 
         train_loss_list = []
@@ -79,26 +97,47 @@ class Trainer():
 
         epoch_list = []
 
-        for epoch in range(1, args.epochs + 1):
+        # Checkpoints are written on a background thread while the next epoch trains
+        resume_path = latest_checkpoint(save_path) if args.resume == 'latest' else args.resume
+        self.checkpoints = CheckpointManager(save_path, keep_last=args.keep_last, keep_best=args.keep_best,
+                                             resume=resume_path is not None) if is_main_process() else None
+        start_epoch = 1
+        if resume_path is not None:
+            checkpoint = resume(resume_path, self.model, self.optimizer, self.scheduler, self.scaler)
+            start_epoch = checkpoint['epoch'] + 1
+            state = checkpoint['trainer']
+            min_loss, early_stopping = state['min_loss'], state['early_stopping']
+            best_epoch, best_mae = state['best_epoch'], state['best_mae']
+            train_loss_list, val_loss_list = state['train_loss_list'], state['val_loss_list']
+            train_mae_list, val_mae_list = state['train_mae_list'], state['val_mae_list']
+            epoch_list = state['epoch_list']
+            if is_main_process():
+                print(f'###### Resumed from {resume_path}, epoch {start_epoch} ######')
+
+        for epoch in range(start_epoch, args.epochs + 1):
             self.epoch = epoch
             epoch_list.append(epoch)
+            if self.distributed:
+                self.train_loader.sampler.set_epoch(epoch)
             train_loss, train_mae = self.training(args)
             train_loss_list.append(train_loss)
             train_mae_list.append(train_mae)
 
-            val_loss, val_mae = self.validate()
+            val_loss, val_mae, val_s_m = self.validate()
             val_loss_list.append(val_loss)
             val_mae_list.append(val_mae)
 
-            save_plot(train_loss_list, val_loss_list, epoch_list, "Loss")
-            save_plot(train_mae_list, val_mae_list, epoch_list, "MAE")
+            if is_main_process():
+                save_plot(train_loss_list, val_loss_list, epoch_list, "Loss", args.epochs)
+                save_plot(train_mae_list, val_mae_list, epoch_list, "MAE", args.epochs)
 
-            # Train
-            self.writer.add_scalar("Loss/train", train_loss, epoch)
-            self.writer.add_scalar("MAE/train", train_mae, epoch)
-            #Val
-            self.writer.add_scalar("Loss/val", val_loss, epoch)
-            self.writer.add_scalar("MAE/val", val_mae, epoch)
+                # Train
+                self.writer.add_scalar("Loss/train", train_loss, epoch)
+                self.writer.add_scalar("MAE/train", train_mae, epoch)
+                #Val
+                self.writer.add_scalar("Loss/val", val_loss, epoch)
+                self.writer.add_scalar("MAE/val", val_mae, epoch)
+                self.writer.add_scalar("S_Measure/val", val_s_m, epoch)
 
             
 
@@ -108,24 +147,33 @@ class Trainer():
             else:
                 self.scheduler.step()
             
-            torch.save(self.model.state_dict(), os.path.join(save_path, f"{epoch}_model_weights.pth"))
-
-            # Save models
+            # Save models (val_loss is all-reduced, so every rank takes the same branch)
             if val_loss < min_loss:
                 early_stopping = 0
                 best_epoch = epoch
                 best_mae = val_mae
                 min_loss = val_loss
-                torch.save(self.model.state_dict(), os.path.join(save_path, 'best_model.pth'))
-                print(f'-----------------SAVING BEST WEIGHTS:{best_epoch}epoch----------------')
+                if is_main_process():
+                    print(f'-----------------SAVING BEST WEIGHTS:{best_epoch}epoch----------------')
             else:
                 early_stopping += 1
 
+            if is_main_process():
+                self.checkpoints.save(epoch, float(val_loss), self.model, self.optimizer, self.scheduler, self.scaler,
+                                      trainer_state={'min_loss': min_loss, 'early_stopping': early_stopping,
+                                                     'best_epoch': best_epoch, 'best_mae': best_mae,
+                                                     'train_loss_list': train_loss_list, 'val_loss_list': val_loss_list,
+                                                     'train_mae_list': train_mae_list, 'val_mae_list': val_mae_list,
+                                                     'epoch_list': epoch_list},
+                                      is_best=best_epoch == epoch)
+
             if early_stopping == args.patience + 5:
                 break
 
-        print(f'\nBest Val Epoch:{best_epoch} | Val Loss:{min_loss:.3f} | Val MAE:{best_mae:.3f} '
-              f'time: {(time.time() - t) / 60:.3f}M')
+        if is_main_process():
+            self.checkpoints.close()  # the test below reads best_model.pth
+            print(f'\nBest Val Epoch:{best_epoch} | Val Loss:{min_loss:.3f} | Val MAE:{best_mae:.3f} '
+                  f'time: {(time.time() - t) / 60:.3f}M')
 
         # Test time
         datasets = ['car_data']
@@ -133,36 +181,37 @@ class Trainer():
             args.dataset = dataset
             test_loss, test_mae, test_maxf, test_avgf, test_s_m = self.test(args, os.path.join(save_path))
 
-            print(
-                f'Test Loss:{test_loss:.3f} | MAX_F:{test_maxf:.3f} | AVG_F:{test_avgf:.3f} | MAE:{test_mae:.3f} '
-                f'| S_Measure:{test_s_m:.3f}, time: {time.time() - t:.3f}s')
+            if is_main_process():
+                print(
+                    f'Test Loss:{test_loss:.3f} | MAX_F:{test_maxf:.3f} | AVG_F:{test_avgf:.3f} | MAE:{test_mae:.3f} '
+                    f'| S_Measure:{test_s_m:.3f}, time: {time.time() - t:.3f}s')
 
         end = time.time()
-        print(f'Total Process time:{(end - t) / 60:.3f}Minute')
+        if is_main_process():
+            print(f'Total Process time:{(end - t) / 60:.3f}Minute')
 
     def training(self, args):
         self.model.train()
         train_loss = AvgMeter()
         train_mae = AvgMeter()
 
-        for images, masks, edges, original_size, image_name in tqdm(self.train_loader):
-            images = torch.tensor(images, device=self.device, dtype=torch.float32)
+        for images, masks, edges, original_size, image_name in tqdm(self.train_loader, disable=not is_main_process()):
+            images = torch.tensor(images, device=self.device, dtype=torch.float32).contiguous(memory_format=self.memory_format)
             masks = torch.tensor(masks, device=self.device, dtype=torch.float32)
             edges = torch.tensor(edges, device=self.device, dtype=torch.float32)
 
             self.optimizer.zero_grad()
-            outputs, edge_mask, ds_map = self.model(images)
-            loss1 = self.criterion(outputs, masks)
-            loss2 = self.criterion(ds_map[0], masks)
-            loss3 = self.criterion(ds_map[1], masks)
-            loss4 = self.criterion(ds_map[2], masks)
-
-            loss_mask = self.criterion(edge_mask, edges)
-            loss = loss1 + loss2 + loss3 + loss4 + loss_mask
+            with torch.cuda.amp.autocast(enabled=self.amp):
+                outputs, edge_mask, ds_map = self.model(images)
+            # the output and the three side outputs share one set of adaptive weights
+            loss_maps = self.multi_criterion([outputs, *ds_map], masks)
+            loss_mask = self.multi_criterion([edge_mask], edges)
+            loss = loss_maps.sum() + loss_mask.sum()
 
-            loss.backward()
+            self.scaler.scale(loss).backward()
 #             nn.utils.clip_grad_norm_(self.model.parameters(), args.clipping)
-            self.optimizer.step()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
             # Metric
             mae = torch.mean(torch.abs(outputs - masks))
@@ -171,8 +220,11 @@ class Trainer():
             train_loss.update(loss.item(), n=images.size(0))
             train_mae.update(mae.item(), n=images.size(0))
 
-        print(f'Epoch:[{self.epoch:03d}/{args.epochs:03d}]')
-        print(f'Train Loss:{train_loss.avg:.3f} | MAE:{train_mae.avg:.3f}')
+        train_loss.all_reduce(self.device)
+        train_mae.all_reduce(self.device)
+        if is_main_process():
+            print(f'Epoch:[{self.epoch:03d}/{args.epochs:03d}]')
+            print(f'Train Loss:{train_loss.avg:.3f} | MAE:{train_mae.avg:.3f}')
 
         return train_loss.avg, train_mae.avg
     
@@ -187,14 +239,21 @@ class Trainer():
         self.model.eval()
         val_loss = AvgMeter()
         val_mae = AvgMeter()
+        val_s_m = AvgMeter()
+        Eval_tool = Evaluation_metrics(self.args.dataset, self.device)
+        # validation inputs and cutouts go under --output_path
+        plot_sink = get_sink(self.args, os.path.join(self.args.output_path, 'val_images'))
+        pred_sink = get_sink(self.args, os.path.join(self.args.output_path, 'val_cutouts'))
 
-        with torch.no_grad():
-            for images, masks, edges, original_size, image_name in tqdm(self.val_loader):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
+        with torch.no_grad(), plot_sink, pred_sink:
+            for images, masks, edges, original_size, image_name in tqdm(self.val_loader, disable=not is_main_process()):
+                images = torch.tensor(images, device=self.device, dtype=torch.float32).contiguous(memory_format=self.memory_format)
                 masks = torch.tensor(masks, device=self.device, dtype=torch.float32)
                 edges = torch.tensor(edges, device=self.device, dtype=torch.float32)
 
-                outputs, edge_mask, ds_map = self.model(images)
+                with torch.cuda.amp.autocast(enabled=self.amp):
+                    outputs, edge_mask, ds_map = self.model(images)
+                outputs = outputs.float()
 
                 # writing down 3 images per batch of val images in pred_map folder
                 # START ------------------------------------------------------------
@@ -221,7 +280,7 @@ class Trainer():
                     # orig_image = np.array(orig_image.cpu())
                     orig_image = (orig_image.detach().cpu().numpy()*255.0).astype(np.uint8)
                     print(orig_image.shape)
-                    cv2.imwrite('/content/TRACER/plots/'+str(i)+'.png', orig_image)
+                    plot_sink.submit(str(i), orig_image)
                             # orig_image = cv2.cvtColor(orig_image, cv2.COLOR_BGR2RGB)
                     output_image = self.apply_mask(image=orig_image, mask=pred_mask)
                     h = orig_image.shape[0]
@@ -236,42 +295,51 @@ class Trainer():
                     # index = np.where(output_image[:,:,3] < 127)
                     # output_image[index] = [0,0,0,0]
                     # print(image_name[i])
-                    output_image = self.post_process.postprocess(output_image, w, h)
-                    cv2.imwrite(os.path.join('/content/TRACER/pred_map/', image_name[i]+'.png'), output_image)
+                    pred_sink.submit(image_name[i], output_image, w, h, fn=self.post_process.postprocess)
                 # END-------------------------------------------------------------------------------------------
 
 
 
-                loss1 = self.criterion(outputs, masks)
-                loss2 = self.criterion(ds_map[0], masks)
-                loss3 = self.criterion(ds_map[1], masks)
-                loss4 = self.criterion(ds_map[2], masks)
-
-                loss_mask = self.criterion(edge_mask, edges)
-                loss = loss1 + loss2 + loss3 + loss4 + loss_mask
+                # the output and the three side outputs share one set of adaptive weights
+                loss_maps = self.multi_criterion([outputs, *ds_map], masks)
+                loss_mask = self.multi_criterion([edge_mask], edges)
+                loss = loss_maps.sum() + loss_mask.sum()
 
                 # Metric
                 mae = torch.mean(torch.abs(outputs - masks))
 
+                s_score = Eval_tool.cal_s_measure(outputs, masks)
+
                 # log
                 val_loss.update(loss.item(), n=images.size(0))
                 val_mae.update(mae.item(), n=images.size(0))
+                val_s_m.update(s_score.mean(), n=images.size(0))
 
-        print(f'Valid Loss:{val_loss.avg:.3f} | MAE:{val_mae.avg:.3f}')
-        return val_loss.avg, val_mae.avg
+        val_loss.all_reduce(self.device)
+        val_mae.all_reduce(self.device)
+        val_s_m.all_reduce(self.device)
+        val_s_m = float(val_s_m.avg)
+        if is_main_process():
+            print(f'Valid Loss:{val_loss.avg:.3f} | MAE:{val_mae.avg:.3f} | S_Measure:{val_s_m:.3f}')
+        return val_loss.avg, val_mae.avg, val_s_m
 
     def test(self, args, save_path):
         path = os.path.join(save_path, 'best_model.pth')
         # if args.multi_gpu:
         #     self.model = nn.DataParallel(self.model).to(self.device)
-        self.model.load_state_dict(torch.load(path))
-        print('###### pre-trained Model restored #####')
+        barrier()  # rank 0 may still be writing best_model.pth
+        unwrap(self.model).load_state_dict(load_checkpoint(path, self.device))
+        if is_main_process():
+            print('###### pre-trained Model restored #####')
 
         te_img_folder = os.path.join(args.data_path, args.dataset, 'Test/images/')
         te_gt_folder = os.path.join(args.data_path, args.dataset, 'Test/masks/')
         test_loader = get_loader(te_img_folder, te_gt_folder, edge_folder=None, phase='test',
                                  batch_size=args.batch_size, shuffle=False,
-                                 num_workers=args.num_workers, transform=self.test_transform)
+                                 num_workers=args.num_workers, transform=self.test_transform,
+                                 distributed=self.distributed)
+        # Ranks may get a different number of test batches, so run outside the DDP wrapper
+        model = local_model(self.model)
 
         self.model.eval()
         test_loss = AvgMeter()
@@ -283,36 +351,40 @@ class Trainer():
         Eval_tool = Evaluation_metrics(args.dataset, self.device)
 
         with torch.no_grad():
-            for i, (images, masks, original_size, image_name) in enumerate(tqdm(test_loader)):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
+            for images, masks, original_size, image_name in tqdm(test_loader, disable=not is_main_process()):
+                images = images.to(self.device, dtype=torch.float32, memory_format=self.memory_format, non_blocking=True)
+                masks = masks.to(self.device, non_blocking=True).float()
 
-                outputs, edge_mask, ds_map = self.model(images)
-                H, W = original_size
-
-                for i in range(images.size(0)):
-                    mask = gt_to_tensor(masks[i])
-
-                    h, w = H[i].item(), W[i].item()
+                with torch.cuda.amp.autocast(enabled=self.amp):
+                    outputs, edge_mask, ds_map = model(images)
+                outputs = outputs.float()
 
-                    output = F.interpolate(outputs[i].unsqueeze(0), size=(h, w), mode='bilinear')
+                # Batches are grouped by original size, so the whole batch shares one (h, w)
+                H, W = original_size
+                h, w = H[0].item(), W[0].item()
+                outputs = F.interpolate(outputs, size=(h, w), mode='bilinear')
 
-                    loss = self.criterion(output, mask)
+                # per-image losses, so the mean does not depend on the batch size or the size grouping
+                loss = self.criterion(outputs, masks, reduction='none')
 
-                    # Metric
-                    mae, max_f, avg_f, s_score = Eval_tool.cal_total_metrics(output, mask)
+                # Metric
+                mae, max_f, avg_f, s_score = Eval_tool.cal_batch_metrics(outputs, masks)
 
-                    # log
-                    test_loss.update(loss.item(), n=1)
-                    test_mae.update(mae, n=1)
-                    test_maxf.update(max_f, n=1)
-                    test_avgf.update(avg_f, n=1)
-                    test_s_m.update(s_score, n=1)
-
-            test_loss = test_loss.avg
-            test_mae = test_mae.avg
-            test_maxf = test_maxf.avg
-            test_avgf = test_avgf.avg
-            test_s_m = test_s_m.avg
+                # log
+                n = images.size(0)
+                test_loss.update(loss.mean(), n=n)
+                test_mae.update(mae.mean(), n=n)
+                test_maxf.update(max_f.mean(), n=n)
+                test_avgf.update(avg_f.mean(), n=n)
+                test_s_m.update(s_score.mean(), n=n)
+
+            for meter in (test_loss, test_mae, test_maxf, test_avgf, test_s_m):
+                meter.all_reduce(self.device)
+            test_loss = float(test_loss.avg)
+            test_mae = float(test_mae.avg)
+            test_maxf = float(test_maxf.avg)
+            test_avgf = float(test_avgf.avg)
+            test_s_m = float(test_s_m.avg)
 
         return test_loss, test_mae, test_maxf, test_avgf, test_s_m
 
@@ -320,29 +392,46 @@ class Trainer():
 class Tester():
     def __init__(self, args, save_path: str, model_name: str, have_gt: bool = True):
         super(Tester, self).__init__()
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.test_transform = get_test_augmentation(img_size=args.img_size)
+        self.device = init_distributed(args)
+        self.distributed = is_distributed()
+        # --aspect_buckets: letterboxed inputs that keep the aspect ratio instead of the squashing Resize
+        self.letterbox = args.img_size if args.aspect_buckets else None
+        if self.letterbox is not None:
+            self.test_transform = get_normalize_augmentation()
+        else:
+            self.test_transform = get_test_augmentation(img_size=args.img_size)
         self.args = args
         self.save_path = save_path
         self.have_gt = have_gt
         self.post_process = PostProcess()
         self.model_name = model_name
+        self.amp = bool(args.amp) and self.device.type == 'cuda'
 
         # Network
-        self.model = self.model = TRACER(args).to(self.device)
-        if args.multi_gpu:
-            self.model = nn.DataParallel(self.model).to(self.device)
-
-        
-        self.model.load_state_dict(torch.load('/content/TRACER/results/22_model_weights.pth'))
+        # channels_last under --profile fast, NCHW otherwise
+        self.memory_format = memory_format(args.profile)
+        if args.checkpoint is not None:
+            # anything load_model understands: fp32 weights, TorchScript / ONNX exports or an int8 model
+            self.model = load_model(args, args.checkpoint, self.device)
+            if is_cpu_only(self.model):
+                self.device = torch.device('cpu')
+                self.amp = False
+            elif isinstance(self.model, TRACER):
+                self.model = wrap_model(self.model, args, self.device)
+        else:
+            self.model = self.model = TRACER(args).to(self.device, memory_format=self.memory_format)
+            self.model = wrap_model(self.model, args, self.device)
+
+            unwrap(self.model).load_state_dict(load_checkpoint('/content/TRACER/results/22_model_weights.pth', self.device))
 
         self.criterion = Criterion(args)
 
         te_img_folder = os.path.join(args.data_path, args.dataset, 'Test/images/')
-        te_gt_folder = os.path.join(args.data_path, args.dataset, 'Test/masks/') if self.have_gt else te_img_folder
+        te_gt_folder = os.path.join(args.data_path, args.dataset, 'Test/masks/') if self.have_gt else None
         self.test_loader = get_loader(te_img_folder, te_gt_folder, edge_folder=None, phase='test',
                                       batch_size=args.batch_size, shuffle=False,
-                                      num_workers=args.num_workers, transform=self.test_transform)
+                                      num_workers=args.num_workers, transform=self.test_transform,
+                                      distributed=self.distributed, letterbox=self.letterbox)
         self.te_img_name_to_te_img_file = {
             ntpath.basename(image_file).rpartition('.')[0]: image_file for image_file in sorted(glob.glob(te_img_folder + '/*'))
         }
@@ -362,6 +451,8 @@ class Tester():
 
     def test(self):
         self.model.eval()
+        # Ranks may get a different number of test batches, so run outside the DDP wrapper
+        model = local_model(self.model)
         test_loss = AvgMeter()
         test_mae = AvgMeter()
         test_maxf = AvgMeter()
@@ -370,65 +461,69 @@ class Tester():
         t = time.time()
 
         Eval_tool = Evaluation_metrics(self.args.dataset, self.device)
+        sink = nullcontext()
+        if self.args.save_map is not None:
+            # encoding and writing run on the sink's threads while the next batch is in flight
+            sink = get_sink(self.args, self.output_path, max_pending=2 * self.args.batch_size)
 
-        with torch.no_grad():
-            for i, (images, masks, original_size, image_name) in enumerate(tqdm(self.test_loader)):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
+        # leaving the block waits for the last writes and stops the writer threads, also on errors
+        with torch.no_grad(), sink:
+            for images, masks, original_size, image_name in tqdm(self.test_loader, disable=not is_main_process()):
+                images = images.to(self.device, dtype=torch.float32, memory_format=self.memory_format, non_blocking=True)
 
-                outputs, edge_mask, ds_map = self.model(images)
+                with torch.cuda.amp.autocast(enabled=self.amp):
+                    outputs, edge_mask, ds_map = model(images)
+                outputs = outputs.float()
 
+                # Batches are grouped by original size, so the whole batch shares one (h, w)
                 H, W = original_size
+                h, w = H[0].item(), W[0].item()
+                if self.letterbox is not None:
+                    # and one letterboxed size: drop the padding before resizing the batch back
+                    vh, vw = letterbox_size(h, w, self.letterbox)[0]
+                    outputs = outputs[:, :, :vh, :vw]
+                outputs = F.interpolate(outputs, size=(h, w), mode='bilinear')
+
+                # Save prediction map
+                if self.args.save_map is not None:
+                    pred_masks = (outputs.squeeze(1) * 255.0).to(torch.uint8)   # convert uint8 type
+                    if not self.have_gt:
+                        # read the original image files; the batch shares one size, so they stack
+                        orig_images = np.stack([cv2.imread(self.te_img_name_to_te_img_file[name]) for name in image_name])
+                        orig_images = torch.from_numpy(orig_images).to(self.device, non_blocking=True)
+                    else:
+                        orig_images = pred_masks.unsqueeze(3).expand(-1, -1, -1, 3)
+                    # composite the whole batch on the device and download it once
+                    output_images = self.post_process.composite(orig_images, pred_masks, w, h).cpu().numpy()
+                    for i in range(images.size(0)):
+                        sink.submit(image_name[i], output_images[i])
+
+                if self.have_gt:
+                    masks = masks.to(self.device, non_blocking=True).float()
+                    # per-image losses, so the mean does not depend on the batch size or the size grouping
+                    loss = self.criterion(outputs, masks, reduction='none')
 
-                for i in range(images.size(0)):
-                    h, w = H[i].item(), W[i].item()
-                    pred_mask = F.interpolate(outputs[i].unsqueeze(0), size=(h, w), mode='bilinear')
-                    # _, shadow_masks = inference()
-
-                    # Save prediction map
-                    if self.args.save_map is not None:
-                        pred_mask = (pred_mask.squeeze().detach().cpu().numpy()*255.0).astype(np.uint8)   # convert uint8 type
-                        if not self.have_gt:
-                            # read the original image file
-                            orig_image = cv2.imread(self.te_img_name_to_te_img_file[image_name[i]])
-
-                            # orig_image = cv2.cvtColor(orig_image, cv2.COLOR_BGR2RGB)
-                            output_image = self.apply_mask(image=orig_image, mask=pred_mask)
-                            h = orig_image.shape[0]
-                            w = orig_image.shape[1]
-                            
+                    # Metric
+                    mae, max_f, avg_f, s_score = Eval_tool.cal_batch_metrics(outputs, masks)
 
-                            
-                        else:
-                            print('here')
-                            output_image = pred_mask
-                        # print(output_image.shape)
-                        # index = np.where(output_image[:,:,3] < 127)
-                        # output_image[index] = [0,0,0,0]
-                        output_image = self.post_process.postprocess(output_image, w, h)
-                        cv2.imwrite(os.path.join('/content/TRACER/plots/', image_name[i]+'.png'), output_image)
-
-                    if self.have_gt:
-                        mask = gt_to_tensor(masks[i])
-                        loss = self.criterion(pred_mask, mask)
-
-                        # Metric
-                        mae, max_f, avg_f, s_score = Eval_tool.cal_total_metrics(pred_mask, mask)
-
-                        # log
-                        test_loss.update(loss.item(), n=1)
-                        test_mae.update(mae, n=1)
-                        test_maxf.update(max_f, n=1)
-                        test_avgf.update(avg_f, n=1)
-                        test_s_m.update(s_score, n=1)
+                    # log
+                    n = images.size(0)
+                    test_loss.update(loss.mean(), n=n)
+                    test_mae.update(mae.mean(), n=n)
+                    test_maxf.update(max_f.mean(), n=n)
+                    test_avgf.update(avg_f.mean(), n=n)
+                    test_s_m.update(s_score.mean(), n=n)
 
             if self.have_gt:
-                test_loss = test_loss.avg
-                test_mae = test_mae.avg
-                test_maxf = test_maxf.avg
-                test_avgf = test_avgf.avg
-                test_s_m = test_s_m.avg
-
-        if self.have_gt:
+                for meter in (test_loss, test_mae, test_maxf, test_avgf, test_s_m):
+                    meter.all_reduce(self.device)
+                test_loss = float(test_loss.avg)
+                test_mae = float(test_mae.avg)
+                test_maxf = float(test_maxf.avg)
+                test_avgf = float(test_avgf.avg)
+                test_s_m = float(test_s_m.avg)
+
+        if self.have_gt and is_main_process():
             print(f'Test Loss:{test_loss:.4f} | MAX_F:{test_maxf:.4f} | MAE:{test_mae:.4f} '
                   f'| S_Measure:{test_s_m:.4f}, time: {time.time() - t:.3f}s')
 
@@ -0,0 +1,279 @@
+import os
+import json
+import mmap
+import random
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.nn as nn
+
+# safetensors dtype names; the files can be read by the safetensors package as well
+DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+WRAPPER_PREFIXES = ('module.', '_orig_mod.')  # nn.DataParallel / DDP, torch.compile
+
+
+def normalize_keys(state_dict):
+    """Strips the wrapper prefixes that DataParallel, DDP and torch.compile put in front of every key."""
+    normalized = {}
+    for key, value in state_dict.items():
+        while key.startswith(WRAPPER_PREFIXES):
+            key = key.split('.', 1)[1]
+        normalized[key] = value
+    return normalized
+
+
+def unwrap(model):
+    """The module inside nn.DataParallel / DistributedDataParallel, the model itself otherwise."""
+    return model.module if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else model
+
+
+def is_tensor_file(path):
+    return path.endswith('.safetensors')
+
+
+def save_tensors(state_dict, path, metadata=None):
+    """Writes state_dict in the safetensors layout: an 8-byte little-endian header size, a JSON header
+    {name: {dtype, shape, data_offsets}} padded to 8 bytes, then the raw little-endian tensor bytes."""
+    header, offset = {}, 0
+    tensors = {key: value.detach().cpu().contiguous() for key, value in normalize_keys(state_dict).items()}
+    for key, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        header[key] = {'dtype': DTYPE_NAMES[tensor.dtype], 'shape': list(tensor.shape),
+                       'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header['__metadata__'] = {key: str(value) for key, value in metadata.items()}
+    header = json.dumps(header, separators=(',', ':')).encode()
+    header += b' ' * (-len(header) % 8)
+
+    tmp = f'{path}.{os.getpid()}.tmp'  # readers never map half a file
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for tensor in tensors.values():
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp, path)
+    return path
+
+
+def load_tensors(path, device='cpu'):
+    """State dict of a safetensors file whose tensors are views of a memory-mapped copy of the file.
+
+    Nothing is read up front: on the CPU the pages are faulted in when a tensor is first used, and for
+    another device every tensor is copied from the mapping straight to that device. The mapping is
+    private (copy-on-write), so the tensors are writable without touching the file.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_size = struct.unpack('<Q', buffer[:8])[0]
+    header = json.loads(buffer[8:8 + header_size])
+    header.pop('__metadata__', None)
+
+    start = 8 + header_size
+    state_dict = {}
+    for key, info in header.items():
+        begin, end = info['data_offsets']
+        dtype = DTYPES[info['dtype']]
+        if end > begin:
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=(end - begin) // dtype.itemsize, offset=start + begin)
+        else:
+            tensor = torch.empty(0, dtype=dtype)
+        state_dict[key] = tensor.view(info['shape']).to(device)
+    return state_dict
+
+
+def read_metadata(path):
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        return json.loads(f.read(header_size)).get('__metadata__', {})
+
+
+def load_into_meta(build, path, device):
+    """Builds a model on the meta device (no memory allocated, no initialization) with build() and
+    assigns the tensors of a safetensors checkpoint as its parameters and buffers.
+
+    On the CPU the parameters are the memory-mapped views themselves, so the peak host memory is
+    the file's page cache instead of an initialized model plus a deserialized copy.
+    """
+    with torch.device('meta'):
+        model = build()
+    model.load_state_dict(load_tensors(path, device), assign=True)
+    return model
+
+
+def is_training_checkpoint(checkpoint):
+    """Whether a loaded .pth holds a CheckpointManager snapshot rather than bare model weights."""
+    return isinstance(checkpoint, dict) and 'model' in checkpoint and 'optimizer' in checkpoint
+
+
+def load_checkpoint(path, device='cpu'):
+    """Prefix-free state dict of a .safetensors (memory-mapped) or .pth checkpoint, for unwrap(model).load_state_dict.
+    The model weights of a full training checkpoint are accepted as well."""
+    if is_tensor_file(path):
+        return load_tensors(path, device)
+    checkpoint = torch.load(path, map_location=device, weights_only=True)
+    return normalize_keys(checkpoint['model'] if is_training_checkpoint(checkpoint) else checkpoint)
+
+
+def to_cpu(obj):
+    """Deep copy of a (nested) state dict with every tensor copied to the CPU, so that the training
+    thread can keep updating the originals while the copy is written."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    """Python, NumPy, torch and CUDA generator states as tensors and python scalars, which the
+    weights_only unpickler accepts (NumPy's key array is stored as a tensor)."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'python': random.getstate(),
+             'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def checkpoint_path(save_path, epoch):
+    return os.path.join(save_path, f'{epoch}_checkpoint.pth')
+
+
+def checkpoint_index(save_path):
+    return os.path.join(save_path, 'checkpoints.json')
+
+
+def read_index(save_path):
+    if not os.path.isfile(checkpoint_index(save_path)):
+        return {}
+    with open(checkpoint_index(save_path)) as f:
+        return {int(epoch): metric for epoch, metric in json.load(f).items()}
+
+
+def latest_checkpoint(save_path):
+    """Path of the newest checkpoint a CheckpointManager kept in save_path, None if there is none."""
+    epochs = [epoch for epoch in read_index(save_path) if os.path.isfile(checkpoint_path(save_path, epoch))]
+    return checkpoint_path(save_path, max(epochs)) if epochs else None
+
+
+class CheckpointManager():
+    """Writes training checkpoints on a background thread and keeps the last keep_last and the best
+    keep_best of them.
+
+    save() copies the model, optimizer, scheduler and grad scaler state to the CPU on the calling
+    thread (a device-to-host copy, no serialization) and returns; torch.save runs on the writer
+    thread while the next epoch trains, and with is_best the weights also go to best_model.pth.
+    At most one write is in flight: save() first waits for the previous one, so a slow disk costs
+    one snapshot of host memory, never a growing queue. Errors raised by the writer resurface at the
+    next save() or close(). Checkpoints of later epochs than the one saved (a previous run in the
+    same folder, or the future of a resumed-from epoch) are removed.
+
+    Files under save_path, all written through a temporary file and os.replace:
+        <epoch>_checkpoint.pth  model (without the 'module.' prefix), optimizer, scheduler, scaler and
+                                RNG states plus the trainer's bookkeeping, for an exact resume,
+        best_model.pth          the weights of the best epoch so far, for test / apply / export,
+        checkpoints.json        epoch -> metric of the retained checkpoints (lower is better), which
+                                decides the keep_best ones; read back only with resume=True.
+    """
+    def __init__(self, save_path, keep_last=3, keep_best=1, resume=False):
+        self.save_path = save_path
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint-writer')
+        self.pending = None
+        os.makedirs(save_path, exist_ok=True)
+        self.index_path = checkpoint_index(save_path)
+        # a fresh run starts a new index, so it never ranks or deletes its checkpoints against the metrics
+        # of an earlier run in the same folder (whose files are left alone, apart from same-epoch overwrites)
+        self.metrics = read_index(save_path) if resume else {}
+
+    def path(self, epoch):
+        return checkpoint_path(self.save_path, epoch)
+
+    def save(self, epoch, metric, model, optimizer, scheduler=None, scaler=None, trainer_state=None, is_best=False):
+        self.wait()
+        checkpoint = {
+            'epoch': epoch,
+            'metric': metric,
+            'model': to_cpu(normalize_keys(unwrap(model).state_dict())),
+            'optimizer': to_cpu(optimizer.state_dict()),
+            'scheduler': to_cpu(scheduler.state_dict()) if scheduler is not None else None,
+            'scaler': to_cpu(scaler.state_dict()) if scaler is not None else None,
+            'rng': rng_state(),
+            'trainer': to_cpu(trainer_state or {}),  # copies the metric lists the trainer keeps appending to
+        }
+        self.pending = self.pool.submit(self._write, checkpoint, is_best)
+
+    def _write(self, checkpoint, best):
+        epoch = checkpoint['epoch']
+        self._save(checkpoint, self.path(epoch))
+        if best:
+            self._save(checkpoint['model'], os.path.join(self.save_path, 'best_model.pth'))
+        self.metrics[epoch] = checkpoint['metric']
+        self._rotate(epoch)
+
+    @staticmethod
+    def _save(obj, path):
+        tmp = f'{path}.{os.getpid()}.tmp'
+        torch.save(obj, tmp)
+        os.replace(tmp, path)
+
+    def _rotate(self, current):
+        stale = [epoch for epoch in self.metrics if epoch > current]
+        kept = {epoch: metric for epoch, metric in self.metrics.items() if epoch <= current}
+        last = sorted(kept)[-self.keep_last:] if self.keep_last > 0 else []
+        best = sorted(kept, key=lambda epoch: (kept[epoch], epoch))[:self.keep_best]
+        for epoch in set(stale) | (set(kept) - set(last) - set(best)):
+            if os.path.isfile(self.path(epoch)):
+                os.remove(self.path(epoch))
+            del self.metrics[epoch]
+        tmp = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.metrics, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.index_path)
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown(wait=True)
+
+
+def resume(path, model, optimizer, scheduler=None, scaler=None):
+    """Restores a CheckpointManager checkpoint in place and returns it (epoch, metric and the
+    trainer's bookkeeping under 'trainer'); training continues at checkpoint['epoch'] + 1."""
+    checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+    if not is_training_checkpoint(checkpoint):
+        raise ValueError(f'{path} holds model weights only, resuming needs an <epoch>_checkpoint.pth')
+    unwrap(model).load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])  # moves the state to the parameters' device
+    if scheduler is not None and checkpoint['scheduler'] is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    if scaler is not None and checkpoint['scaler'] is not None:
+        scaler.load_state_dict(checkpoint['scaler'])
+    set_rng_state(checkpoint['rng'])
+    return checkpoint
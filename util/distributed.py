@@ -0,0 +1,80 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(args):
+    """Joins the process group set up by torchrun and returns this process's device.
+
+    torchrun exports RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT, so the group is
+    initialized from the environment. Without --distributed this just picks the default device.
+    nccl is used when CUDA is available and gloo otherwise (e.g. CPU-only smoke tests).
+    """
+    if not args.distributed:
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    backend = args.dist_backend or ('nccl' if torch.cuda.is_available() else 'gloo')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://')
+    return device
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_model(model, args, device):
+    """DistributedDataParallel under --distributed, nn.DataParallel under --multi_gpu, else as is.
+
+    Both wrappers prefix the state dict with 'module.', so checkpoints stay interchangeable.
+    """
+    if is_distributed():
+        device_ids = [device.index] if device.type == 'cuda' else None
+        return DistributedDataParallel(model, device_ids=device_ids)
+    if args.multi_gpu:
+        return torch.nn.DataParallel(model).to(device)
+    return model
+
+
+def local_model(model):
+    """The module inside DistributedDataParallel, for evaluation passes that must not enter its
+    collectives (e.g. when ranks see a different number of test batches)."""
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def all_reduce_sum(values, device):
+    """Sums a list of python numbers / 0-dim tensors across ranks and returns python floats."""
+    tensor = torch.tensor([float(v) for v in values], dtype=torch.float64, device=device)
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
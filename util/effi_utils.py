@@ -13,34 +13,33 @@ from functools import partial
 import torch
 from torch import nn
 from torch.nn import functional as F
-from torch.utils import model_zoo
-from config import getConfig
+from util.weight_store import resolve_weights
 
-cfg = getConfig()
 
-def get_model_shape():
-    if cfg.arch == '0':
+def get_model_shape(arch):
+    arch = str(arch)
+    if arch == '0':
         block_idx = [2, 4, 10, 15]
         channels = [24, 40, 112, 320]
-    elif cfg.arch == '1':
+    elif arch == '1':
         block_idx = [4, 7, 15, 22]
         channels = [24, 40, 112, 320]
-    elif cfg.arch == '2':
+    elif arch == '2':
         block_idx = [4, 7, 15, 22]
         channels = [24, 48, 120, 352]
-    elif cfg.arch == '3':
+    elif arch == '3':
         block_idx = [4, 7, 17, 25]
         channels = [32, 48, 136, 384]
-    elif cfg.arch == '4':
+    elif arch == '4':
         block_idx = [5, 9, 21, 31]
         channels = [32, 56, 160, 448]
-    elif cfg.arch == '5':
+    elif arch == '5':
         block_idx = [7, 12, 26, 38]
         channels = [40, 64, 176, 512]
-    elif cfg.arch == '6':
+    elif arch == '6':
         block_idx = [8, 14, 30, 44]
         channels = [40, 72, 200, 576]
-    elif cfg.arch == '7':
+    elif arch == '7':
         block_idx = [10, 17, 37, 54]
         channels = [48, 80, 224, 640]
 
@@ -611,17 +610,18 @@ def load_pretrained_weights(model, model_name, weights_path=None, load_fc=True,
         model_name (str): Model name of efficientnet.
         weights_path (None or str):
             str: path to pretrained weights file on the local disk.
-            None: use pretrained weights downloaded from the Internet.
+            None: use pretrained weights from the local weight store (util.weight_store),
+                  downloaded into it on first use unless TRACER_OFFLINE is set.
         load_fc (bool): Whether to load pretrained weights for fc layer at the end of the model.
         advprop (bool): Whether to load pretrained weights
                         trained with advprop (valid when weights_path is None).
     """
     if isinstance(weights_path, str):
-        state_dict = torch.load(weights_path, strict=False)
+        state_dict = torch.load(weights_path, map_location='cpu')
     else:
         # AutoAugment or Advprop (different preprocessing)
         url_map_ = url_map_advprop if advprop else url_map
-        state_dict = model_zoo.load_url(url_map_[model_name])
+        state_dict = torch.load(resolve_weights(model_name, url_map_[model_name], advprop), map_location='cpu')
 
     if load_fc:
         ret = model.load_state_dict(state_dict, strict=False)
@@ -1,9 +1,12 @@
 """
 author: Min Seok Lee and Wooseok Shin
 """
+from functools import partial
 import torch
 import torch.nn.functional as F
 
+API_KERNEL_SIZES = (3, 15, 31)
+
 
 def Optimizer(args, model):
     if args.optimizer == 'Adam':
@@ -25,27 +28,122 @@ def Scheduler(args, optimizer):
 
 def Criterion(args):
     if args.criterion == 'API':
-        criterion = adaptive_pixel_intensity_loss
+        criterion = partial(adaptive_pixel_intensity_loss, box_filter=args.box_filter)
     elif args.criterion == 'bce':
-        criterion = torch.nn.BCELoss()
+        criterion = bce_loss
     return criterion
 
 
-def adaptive_pixel_intensity_loss(pred, mask):
-    w1 = torch.abs(F.avg_pool2d(mask, kernel_size=3, stride=1, padding=1) - mask)
-    w2 = torch.abs(F.avg_pool2d(mask, kernel_size=15, stride=1, padding=7) - mask)
-    w3 = torch.abs(F.avg_pool2d(mask, kernel_size=31, stride=1, padding=15) - mask)
+def MultiCriterion(args):
+    """Criterion for several side outputs against one mask, returns the (K,) per-head losses."""
+    if args.criterion == 'API':
+        criterion = partial(multi_adaptive_pixel_intensity_loss, box_filter=args.box_filter)
+    elif args.criterion == 'bce':
+        criterion = multi_bce_loss
+    return criterion
+
+
+def bce_loss(pred, mask, reduction='mean'):
+    # Called outside autocast on possibly half precision outputs, binary_cross_entropy needs fp32
+    if reduction == 'none':
+        # (B,) per-image losses, each the value the image would get in a batch of its own
+        return F.binary_cross_entropy(pred.float(), mask.float(), reduction='none').mean(dim=(1, 2, 3))
+    return F.binary_cross_entropy(pred.float(), mask.float())
+
+
+def box_means(x, kernel_sizes):
+    """Stride-1 box means of x (B, C, H, W) for each odd kernel size, from one summed-area table.
+
+    Same result as F.avg_pool2d(x, k, stride=1, padding=k // 2) with its default zero padding and
+    count_include_pad=True, but every window sum is four table lookups, so the cost per pixel does not
+    grow with the kernel. The table is accumulated in float64 to keep the differences exact.
+    """
+    h, w = x.size()[-2:]
+    r = max(kernel_sizes) // 2
+    # zero padding of r on every side plus one leading zero row / column for the table
+    sat = F.pad(x.double(), (r + 1, r, r + 1, r)).cumsum(dim=2).cumsum(dim=3)
+
+    means = []
+    for k in kernel_sizes:
+        o = r - k // 2  # offset of each window's top-left corner in the padded map
+        box = (sat[:, :, o + k:o + k + h, o + k:o + k + w] - sat[:, :, o:o + h, o + k:o + k + w]
+               - sat[:, :, o + k:o + k + h, o:o + w] + sat[:, :, o:o + h, o:o + w])
+        means.append((box / (k * k)).to(x.dtype))
+    return means
+
+
+def adaptive_pixel_weights(mask, box_filter='sat'):
+    if box_filter == 'sat':
+        m1, m2, m3 = box_means(mask, API_KERNEL_SIZES)
+    else:
+        m1, m2, m3 = (F.avg_pool2d(mask, kernel_size=k, stride=1, padding=k // 2) for k in API_KERNEL_SIZES)
+    w1 = torch.abs(m1 - mask)
+    w2 = torch.abs(m2 - mask)
+    w3 = torch.abs(m3 - mask)
 
     omega = 1 + 0.5 * (w1 + w2 + w3) * mask
+    return omega
+
 
-    bce = F.binary_cross_entropy(pred, mask, reduce=None)
+def adaptive_pixel_intensity_loss(pred, mask, box_filter='sat', reduction='mean'):
+    """API loss of the batch. bce and mae are means over the whole batch, so the value depends on its
+    composition; reduction='none' returns the (B,) per-image losses instead, each the value the image
+    would get in a batch of its own (for evaluation, where results must not depend on the batching)."""
+    # Called outside autocast on possibly half precision outputs, binary_cross_entropy needs fp32
+    pred, mask = pred.float(), mask.float()
+
+    omega = adaptive_pixel_weights(mask, box_filter)
+
+    if reduction == 'none':
+        bce = F.binary_cross_entropy(pred, mask, reduction='none').mean(dim=(1, 2, 3), keepdim=True)
+    else:
+        bce = F.binary_cross_entropy(pred, mask, reduce=None)
     abce = (omega * bce).sum(dim=(2, 3)) / (omega + 0.5).sum(dim=(2, 3))
 
     inter = ((pred * mask) * omega).sum(dim=(2, 3))
     union = ((pred + mask) * omega).sum(dim=(2, 3))
     aiou = 1 - (inter + 1) / (union - inter + 1)
 
-    mae = F.l1_loss(pred, mask, reduce=None)
+    if reduction == 'none':
+        mae = F.l1_loss(pred, mask, reduction='none').mean(dim=(1, 2, 3), keepdim=True)
+    else:
+        mae = F.l1_loss(pred, mask, reduce=None)
     amae = (omega * mae).sum(dim=(2, 3)) / (omega - 1).sum(dim=(2, 3))
 
-    return (0.7 * abce + 0.7 * aiou + 0.7 * amae).mean()
\ No newline at end of file
+    loss = 0.7 * abce + 0.7 * aiou + 0.7 * amae
+    return loss.mean(dim=1) if reduction == 'none' else loss.mean()
+
+
+def multi_bce_loss(preds, mask):
+    preds = torch.stack([pred.float() for pred in preds])
+    bce = F.binary_cross_entropy(preds, mask.float().expand_as(preds), reduction='none')
+    return bce.mean(dim=(1, 2, 3, 4))
+
+
+def multi_adaptive_pixel_intensity_loss(preds, mask, box_filter='sat'):
+    """adaptive_pixel_intensity_loss of every pred in preds against the same mask, as a (K,) tensor.
+
+    omega and its normalizers depend on the mask only, so they are built once and broadcast over the
+    stacked side outputs instead of being recomputed (three avg_pool2d passes) for every head.
+    As in the single-head loss, bce and mae are means over the whole batch.
+    """
+    preds = torch.stack([pred.float() for pred in preds])  # (K, B, 1, H, W)
+    mask = mask.float()
+    hw = mask.size(2) * mask.size(3)
+
+    omega = adaptive_pixel_weights(mask, box_filter)
+    omega_sum = omega.sum(dim=(2, 3))
+    mask_omega = mask * omega
+    mask_sum = mask_omega.sum(dim=(2, 3))
+
+    bce = F.binary_cross_entropy(preds, mask.expand_as(preds), reduction='none').mean(dim=(1, 2, 3, 4))
+    abce = omega_sum * bce.view(-1, 1, 1) / (omega_sum + 0.5 * hw)
+
+    inter = (preds * mask_omega).sum(dim=(3, 4))
+    union = (preds * omega).sum(dim=(3, 4)) + mask_sum
+    aiou = 1 - (inter + 1) / (union - inter + 1)
+
+    mae = (preds - mask).abs().mean(dim=(1, 2, 3, 4))
+    amae = omega_sum * mae.view(-1, 1, 1) / (omega_sum - hw)
+
+    return (0.7 * abce + 0.7 * aiou + 0.7 * amae).mean(dim=(1, 2))
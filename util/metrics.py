@@ -1,5 +1,4 @@
 import torch
-import numpy as np
 
 
 class Evaluation_metrics():
@@ -21,35 +20,73 @@ class Evaluation_metrics():
         # AvgF measure
         avg_f = f_score.mean().item()
         # S measure
-        alpha = 0.5
-        y = mask.mean()
-        if y == 0:
-            x = pred.mean()
-            Q = 1.0 - x
-        elif y == 1:
-            x = pred.mean()
-            Q = x
-        else:
-            mask[mask >= 0.5] = 1
-            mask[mask < 0.5] = 0
-            Q = alpha * self._S_object(pred, mask) + (1 - alpha) * self._S_region(pred, mask)
-            if Q.item() < 0:
-                Q = torch.FloatTensor([0.0])
-        s_score = Q.item()
+        s_score = self.cal_s_measure(pred, mask).item()
+
+        return mae, max_f, avg_f, s_score
+
+    def cal_batch_metrics(self, preds, masks):
+        """Per-sample metrics for a batch of equally sized maps.
+
+        Args:
+            preds: predictions (B, 1, H, W) in [0, 1].
+            masks: binary ground truth (B, 1, H, W).
+        Returns:
+            mae, max_f, avg_f, s_score: (B,) tensors left on the device, so callers can accumulate
+            them without a host sync per image.
+        """
+        # MAE
+        mae = torch.abs(preds - masks).mean(dim=(1, 2, 3))
+        # MaxF / AvgF measure
+        beta2 = 0.3
+        prec, recall = self._eval_pr(preds, masks, 255)
+        f_score = (1 + beta2) * prec * recall / (beta2 * prec + recall)
+        f_score[f_score != f_score] = 0  # for Nan
+        max_f = f_score.max(dim=1)[0]
+        avg_f = f_score.mean(dim=1)
+        # S measure
+        s_score = self.cal_s_measure(preds, masks)
 
         return mae, max_f, avg_f, s_score
 
+    def cal_s_measure(self, pred, mask):
+        """Batched S-measure for (B, 1, H, W) maps, returned as a (B,) tensor.
+
+        All-background and all-foreground masks fall back to the mean prediction, every other sample
+        mixes object- and region-aware similarity. Both branches are evaluated for the whole batch and
+        selected with torch.where, so nothing is read back to the host.
+        """
+        alpha = 0.5
+        y = mask.mean(dim=(1, 2, 3))
+        x = pred.mean(dim=(1, 2, 3))
+        mask = (mask >= 0.5).to(pred.dtype)
+        Q = alpha * self._S_object(pred, mask) + (1 - alpha) * self._S_region(pred, mask)
+        Q = torch.where(y == 0, 1.0 - x, torch.where(y == 1, x, Q.clamp(min=0.0)))
+        return Q
+
     def _eval_pr(self, y_pred, y, num):
-        if self.device:
-            prec, recall = torch.zeros(num).to(self.device), torch.zeros(num).to(self.device)
-            thlist = torch.linspace(0, 1 - 1e-10, num).to(self.device)
-        else:
-            prec, recall = torch.zeros(num), torch.zeros(num)
-            thlist = torch.linspace(0, 1 - 1e-10, num)
-        for i in range(num):
-            y_temp = (y_pred >= thlist[i]).float()
-            tp = (y_temp * y).sum()
-            prec[i], recall[i] = tp / (y_temp.sum() + 1e-20), tp / (y.sum() + 1e-20)
+        """Precision and recall at `num` evenly spaced thresholds in a single pass.
+
+        Each pixel is bucketized by the number of thresholds it reaches, so a reverse cumulative sum
+        over the bucket histogram gives, for every threshold at once, the count of pixels with
+        y_pred >= threshold (and the mask mass among them). The first dimension is the batch, and
+        prec / recall are returned as (B, num).
+        """
+        B = y_pred.size(0)
+        thlist = torch.linspace(0, 1 - 1e-10, num, device=y_pred.device, dtype=y_pred.dtype)
+        y_pred = y_pred.reshape(B, -1)
+        y = y.reshape(B, -1).double()
+
+        bins = torch.bucketize(y_pred, thlist, right=True)  # number of thresholds <= pixel value
+        bins = bins + torch.arange(B, device=bins.device).unsqueeze(1) * (num + 1)  # one histogram per sample
+        hist = torch.bincount(bins.reshape(-1), minlength=B * (num + 1)).reshape(B, num + 1).double()
+        hist_tp = torch.bincount(bins.reshape(-1), weights=y.reshape(-1), minlength=B * (num + 1)).reshape(B, num + 1)
+
+        # pixels with bin > i are exactly those with y_pred >= thlist[i]
+        pred_pos = hist.flip(1).cumsum(1).flip(1)[:, 1:]
+        tp = hist_tp.flip(1).cumsum(1).flip(1)[:, 1:]
+
+        prec = (tp / (pred_pos + 1e-20)).float()
+        recall = (tp / (y.sum(dim=1, keepdim=True) + 1e-20)).float()
         return prec, recall
 
     def _S_object(self, pred, mask):
@@ -57,94 +94,76 @@ class Evaluation_metrics():
         bg = torch.where(mask == 1, torch.zeros_like(pred), 1 - pred)
         o_fg = self._object(fg, mask)
         o_bg = self._object(bg, 1 - mask)
-        u = mask.mean()
+        u = mask.mean(dim=(1, 2, 3))
         Q = u * o_fg + (1 - u) * o_bg
         return Q
 
     def _object(self, pred, mask):
-        temp = pred[mask == 1]
-        x = temp.mean()
-        sigma_x = temp.std()
+        # mean and unbiased std of pred over the pixels where mask == 1, per sample
+        n = mask.sum(dim=(1, 2, 3))
+        x = (pred * mask).sum(dim=(1, 2, 3)) / n
+        sigma_x = ((pred - x.view(-1, 1, 1, 1)) ** 2 * mask).sum(dim=(1, 2, 3)).div(n - 1).sqrt()
         score = 2.0 * x / (x * x + 1.0 + sigma_x + 1e-20)
 
         return score
 
     def _S_region(self, pred, mask):
         X, Y = self._centroid(mask)
-        mask1, mask2, mask3, mask4, w1, w2, w3, w4 = self._divideGT(mask, X, Y)
-        p1, p2, p3, p4 = self._dividePrediction(pred, X, Y)
-        Q1 = self._ssim(p1, mask1)
-        Q2 = self._ssim(p2, mask2)
-        Q3 = self._ssim(p3, mask3)
-        Q4 = self._ssim(p4, mask4)
-        Q = w1 * Q1 + w2 * Q2 + w3 * Q3 + w4 * Q4
-        # print(Q)
-        return Q
-
-    def _centroid(self, mask):
-        rows, cols = mask.size()[-2:]
-        mask = mask.view(rows, cols)
-        if mask.sum() == 0:
-            if self.device:
-                X = torch.eye(1).to(self.device) * round(cols / 2)
-                Y = torch.eye(1).to(self.device) * round(rows / 2)
-            else:
-                X = torch.eye(1) * round(cols / 2)
-                Y = torch.eye(1) * round(rows / 2)
-        else:
-            total = mask.sum()
-            if self.device:
-                i = torch.from_numpy(np.arange(0, cols)).to(self.device).float()
-                j = torch.from_numpy(np.arange(0, rows)).to(self.device).float()
-            else:
-                i = torch.from_numpy(np.arange(0, cols)).float()
-                j = torch.from_numpy(np.arange(0, rows)).float()
-            X = torch.round((mask.sum(dim=0) * i).sum() / total)
-            Y = torch.round((mask.sum(dim=1) * j).sum() / total)
-        return X.long(), Y.long()
-
-    def _divideGT(self, mask, X, Y):
         h, w = mask.size()[-2:]
         area = h * w
-        mask = mask.view(h, w)
-        LT = mask[:Y, :X]
-        RT = mask[:Y, X:w]
-        LB = mask[Y:h, :X]
-        RB = mask[Y:h, X:w]
-        X = X.float()
-        Y = Y.float()
+        top = (torch.arange(h, device=mask.device) < Y.view(-1, 1)).view(-1, 1, h, 1)
+        left = (torch.arange(w, device=mask.device) < X.view(-1, 1)).view(-1, 1, 1, w)
         w1 = X * Y / area
         w2 = (w - X) * Y / area
         w3 = X * (h - Y) / area
         w4 = 1 - w1 - w2 - w3
-        return LT, RT, LB, RB, w1, w2, w3, w4
+        Q1, Q2, Q3, Q4 = self._ssim(pred, mask, top, left).unbind(dim=1)
+        Q = w1 * Q1 + w2 * Q2 + w3 * Q3 + w4 * Q4
+        return Q
 
-    def _dividePrediction(self, pred, X, Y):
-        h, w = pred.size()[-2:]
-        pred = pred.view(h, w)
-        LT = pred[:Y, :X]
-        RT = pred[:Y, X:w]
-        LB = pred[Y:h, :X]
-        RB = pred[Y:h, X:w]
-        return LT, RT, LB, RB
-
-    def _ssim(self, pred, mask):
-        mask = mask.float()
+    def _centroid(self, mask):
+        rows, cols = mask.size()[-2:]
+        total = mask.sum(dim=(1, 2, 3))
+        i = torch.arange(cols, device=mask.device, dtype=mask.dtype)
+        j = torch.arange(rows, device=mask.device, dtype=mask.dtype)
+        X = torch.round((mask.sum(dim=2).squeeze(1) * i).sum(dim=1) / total)
+        Y = torch.round((mask.sum(dim=3).squeeze(1) * j).sum(dim=1) / total)
+        # empty masks fall back to the image centre
+        X = torch.where(total == 0, torch.full_like(X, round(cols / 2)), X)
+        Y = torch.where(total == 0, torch.full_like(Y, round(rows / 2)), Y)
+        return X, Y
+
+    def _quadrant_sums(self, f, top, left):
+        """Sums of f (B, 1, H, W) over the LT, RT, LB, RB quadrants split at the centroid: (B, 4)."""
+        left_rows = (f * left).sum(dim=3)  # (B, 1, H)
+        right_rows = f.sum(dim=3) - left_rows
+        top = top.squeeze(3)
+        LT = (left_rows * top).sum(dim=(1, 2))
+        RT = (right_rows * top).sum(dim=(1, 2))
+        LB = left_rows.sum(dim=(1, 2)) - LT
+        RB = right_rows.sum(dim=(1, 2)) - RT
+        return torch.stack([LT, RT, LB, RB], dim=1)
+
+    def _quadrant_map(self, values, top, left):
+        """Broadcasts per-quadrant values (B, 4) back to a (B, 1, H, W) map."""
+        LT, RT, LB, RB = (v.view(-1, 1, 1, 1) for v in values.unbind(dim=1))
+        return torch.where(top, torch.where(left, LT, RT), torch.where(left, LB, RB))
+
+    def _ssim(self, pred, mask, top, left):
         h, w = pred.size()[-2:]
-        N = h * w
-        x = pred.mean()
-        y = mask.mean()
-        sigma_x2 = ((pred - x) * (pred - x)).sum() / (N - 1 + 1e-20)
-        sigma_y2 = ((mask - y) * (mask - y)).sum() / (N - 1 + 1e-20)
-        sigma_xy = ((pred - x) * (mask - y)).sum() / (N - 1 + 1e-20)
+        ones = torch.ones_like(pred)
+        N = self._quadrant_sums(ones, top, left)
+        x = self._quadrant_sums(pred, top, left) / N
+        y = self._quadrant_sums(mask, top, left) / N
+        d_x = pred - self._quadrant_map(x, top, left)
+        d_y = mask - self._quadrant_map(y, top, left)
+        sigma_x2 = self._quadrant_sums(d_x * d_x, top, left) / (N - 1 + 1e-20)
+        sigma_y2 = self._quadrant_sums(d_y * d_y, top, left) / (N - 1 + 1e-20)
+        sigma_xy = self._quadrant_sums(d_x * d_y, top, left) / (N - 1 + 1e-20)
 
         aplha = 4 * x * y * sigma_xy
         beta = (x * x + y * y) * (sigma_x2 + sigma_y2)
 
-        if aplha != 0:
-            Q = aplha / (beta + 1e-20)
-        elif aplha == 0 and beta == 0:
-            Q = 1.0
-        else:
-            Q = 0
+        Q = torch.where(aplha != 0, aplha / (beta + 1e-20),
+                        torch.where(beta == 0, torch.ones_like(beta), torch.zeros_like(beta)))
         return Q
@@ -0,0 +1,78 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+SAVE_FORMATS = ('png', 'webp', 'npy')
+
+
+class OutputSink():
+    """Encodes and writes prediction maps / cutouts on a bounded pool of writer threads.
+
+    cv2.imencode and file I/O release the GIL, so threads overlap PNG/WebP compression with the
+    model's forward pass. At most `max_pending` writes are queued; submit() blocks on the oldest one
+    beyond that (backpressure), and flush()/close() wait for everything still in flight. Errors raised
+    in a writer resurface in the caller at the next submit, flush or close.
+
+    Args:
+        output_path: directory the files are written to (created if missing).
+        fmt: 'png', 'webp' or 'npy' (the raw uint8 array, no compression).
+        level: PNG compression level 0-9 or WebP quality 1-100 (>100 is lossless), None for OpenCV's default.
+        num_workers: writer threads.
+        max_pending: queued writes before submit blocks (default: 4 per writer).
+    """
+    def __init__(self, output_path, fmt='png', level=None, num_workers=4, max_pending=None):
+        if fmt not in SAVE_FORMATS:
+            raise ValueError(f'Unknown save format {fmt!r}, expected one of {SAVE_FORMATS}')
+        self.output_path = output_path
+        self.fmt = fmt
+        self.params = []
+        if level is not None and fmt == 'png':
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, int(level)]
+        elif level is not None and fmt == 'webp':
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, int(level)]
+        self.max_pending = max_pending or 4 * num_workers
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        os.makedirs(output_path, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.output_path, f'{name}.{self.fmt}')
+
+    def write(self, name, image):
+        if self.fmt == 'npy':
+            np.save(self.path(name), image)
+        elif not cv2.imwrite(self.path(name), image, self.params):
+            raise IOError(f'Could not write {self.path(name)}')
+
+    def _encode(self, name, fn, args):
+        self.write(name, fn(*args) if fn is not None else args[0])
+
+    def submit(self, name, *args, fn=None):
+        """Queues one output. Without fn, args is the uint8 image itself; with fn, the image is
+        fn(*args), so building a cutout or compositing can also run off the main thread."""
+        self.pending.append(self.pool.submit(self._encode, name, fn, args))
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft().result()
+
+    def flush(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_sink(args, output_path, max_pending=None):
+    return OutputSink(output_path, fmt=args.save_format, level=args.save_level, num_workers=args.num_writers,
+                      max_pending=max_pending)
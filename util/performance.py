@@ -0,0 +1,22 @@
+import torch
+
+PROFILES = ('deterministic', 'fast')
+
+
+def set_performance_profile(profile):
+    """Configures cuDNN for the chosen profile.
+
+    deterministic: reproducible kernels, no autotuning (the previous hard-coded behaviour).
+    fast:          cudnn.benchmark autotunes convolutions for each input shape it sees, which pays off
+                   for the fixed img_size used in training and inference, at the cost of run-to-run
+                   bit reproducibility.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown profile {profile!r}, expected one of {PROFILES}')
+    torch.backends.cudnn.deterministic = profile == 'deterministic'
+    torch.backends.cudnn.benchmark = profile == 'fast'
+
+
+def memory_format(profile):
+    # NHWC lets cuDNN pick its faster kernels for the depthwise convs in MBConvBlock / DWConv / DWSConv
+    return torch.channels_last if profile == 'fast' else torch.contiguous_format
@@ -1,10 +1,8 @@
 import torch
 import matplotlib.pyplot as plt
-from config import getConfig
+from util.distributed import all_reduce_sum
 import os
 
-cfg = getConfig()
-
 def to_array(feature_map):
     if feature_map.shape[0] == 1:
         feature_map = feature_map.squeeze(0).permute(1, 2, 0).detach().cpu().numpy()
@@ -34,11 +32,16 @@ class AvgMeter(object):
         self.avg = self.sum / self.count
         self.losses.append(val)
 
-def save_plot(t, v, e, label):
+    def all_reduce(self, device):
+        # sum and count over every DDP rank, so avg becomes the global average (no-op otherwise)
+        self.sum, self.count = all_reduce_sum([self.sum, self.count], device)
+        self.avg = self.sum / self.count if self.count else 0
+
+def save_plot(t, v, e, label, epochs):
     plt.figure(figsize=(15,8))
     plt.plot(e,t, label=f"Train {label}")
     plt.plot(e, v, label=f"Validation {label}")
-    plt.xticks([i for i in range(1, cfg.epochs+1, 2)])
+    plt.xticks([i for i in range(1, epochs+1, 2)])
     plt.xlabel('epochs')
     plt.ylabel(label)
     plt.title(f"Train and Validation {label}")
@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+from torch.hub import HASH_REGEX, download_url_to_file, get_dir
+
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tracer', 'weights')
+_store_dir = os.environ.get('TRACER_WEIGHTS_DIR', DEFAULT_STORE_DIR)
+
+
+def set_store_dir(path):
+    global _store_dir
+    _store_dir = path
+
+
+def is_offline():
+    # air-gapped nodes set TRACER_OFFLINE=1 so a missing weight fails fast instead of timing out
+    return os.environ.get('TRACER_OFFLINE', '0') not in ('', '0')
+
+
+def weight_key(model_name, advprop=False):
+    return f'adv-{model_name}' if advprop else model_name
+
+
+def sha256sum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WeightStore():
+    """Content-addressed store of pretrained weight files.
+
+    Layout under root:
+        objects/<sha256>.pth  the files, named by the SHA-256 of their content,
+        refs.json             weight_key -> {'sha256', 'size', 'url'}.
+    Files are hashed when they enter the store (and checked against the hash prefix in their
+    release URL), so a lookup only compares the size; verify=True re-hashes the file as well.
+    Writes go through a temporary file and os.replace, so concurrent readers never see half a file.
+    """
+    def __init__(self, root=None):
+        self.root = root or _store_dir
+
+    @property
+    def refs_path(self):
+        return os.path.join(self.root, 'refs.json')
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, 'objects', f'{sha256}.pth')
+
+    def refs(self):
+        if not os.path.isfile(self.refs_path):
+            return {}
+        with open(self.refs_path) as f:
+            return json.load(f)
+
+    def path(self, key, verify=False):
+        """Path of the stored file for key, None if it is missing or incomplete."""
+        ref = self.refs().get(key)
+        if ref is None:
+            return None
+        path = self.object_path(ref['sha256'])
+        if not os.path.isfile(path) or os.path.getsize(path) != ref['size']:
+            return None
+        if verify and sha256sum(path) != ref['sha256']:
+            raise RuntimeError(f'{path} does not match its SHA-256, remove it and run prewarm again')
+        return path
+
+    def add(self, key, file, url=None):
+        """Copies file into the store under key and returns the stored path."""
+        sha256 = sha256sum(file)
+        match = re.search(HASH_REGEX, os.path.basename(url or ''))
+        if match and not sha256.startswith(match.group(1)):
+            raise RuntimeError(f'{file} does not match the hash prefix {match.group(1)} of {url}')
+
+        path = self.object_path(sha256)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            shutil.copyfile(file, tmp)
+            os.replace(tmp, path)
+
+        refs = self.refs()
+        refs[key] = {'sha256': sha256, 'size': os.path.getsize(path), 'url': url}
+        tmp = f'{self.refs_path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(refs, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.refs_path)
+        return path
+
+    def fetch(self, key, url):
+        """Downloads url (checked against its hash prefix) into the store."""
+        os.makedirs(self.root, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.root) as tmp_dir:
+            tmp = os.path.join(tmp_dir, os.path.basename(url))
+            match = re.search(HASH_REGEX, os.path.basename(url))
+            download_url_to_file(url, tmp, hash_prefix=match.group(1) if match else None)
+            return self.add(key, tmp, url)
+
+
+def resolve_weights(model_name, url, advprop=False, verify=False):
+    """Local path of the pretrained weights for model_name, added to the store on first use: from the
+    torch hub cache that model_zoo.load_url used to fill when it holds the release file, else downloaded.
+
+    With TRACER_OFFLINE set nothing is downloaded and a missing entry raises FileNotFoundError.
+    """
+    store = WeightStore()
+    key = weight_key(model_name, advprop)
+    path = store.path(key, verify=verify)
+    if path is not None:
+        return path
+    hub_file = os.path.join(get_dir(), 'checkpoints', os.path.basename(url))
+    if os.path.isfile(hub_file):
+        try:
+            return store.add(key, hub_file, url)
+        except RuntimeError:
+            pass  # a corrupt or partial hub download, fetch a fresh copy
+    if is_offline():
+        raise FileNotFoundError(f'No {key} weights in the store at {store.root} and TRACER_OFFLINE is set. '
+                                f'Run "python main.py prewarm" on a node with network access (or with '
+                                f'--weights_source) and copy the store over.')
+    return store.fetch(key, url)
+
+
+def prewarm(model_names, source=None, variants=('standard', 'advprop')):
+    """Fills the store with the standard and / or advprop weights (TRACER uses advprop) of every model name.
+
+    source is an optional directory of release files (e.g. a copied torch hub checkpoints folder);
+    files found there are imported, the rest is downloaded. Existing entries are re-verified.
+    """
+    from util.effi_utils import url_map, url_map_advprop  # effi_utils resolves its weights through this module
+
+    store = WeightStore()
+    for model_name in model_names:
+        for advprop, urls in ((False, url_map), (True, url_map_advprop)):
+            if ('advprop' if advprop else 'standard') not in variants:
+                continue
+            key, url = weight_key(model_name, advprop), urls[model_name]
+            local = os.path.join(source, os.path.basename(url)) if source else None
+            if store.path(key, verify=True) is not None:
+                status = 'verified'
+            elif local is not None and os.path.isfile(local):
+                store.add(key, local, url)
+                status = f'imported from {local}'
+            elif is_offline():
+                raise FileNotFoundError(f'{key}: {os.path.basename(url)} not found in {source} and TRACER_OFFLINE is set')
+            else:
+                store.fetch(key, url)
+                status = 'downloaded'
+            print(f'{key:>22}: {status} ({store.path(key)})')
+    return store